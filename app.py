@@ -1,18 +1,31 @@
+import fcntl
+import functools
 import hashlib
-import io
+import html
 import json
 import os
 import re
-from datetime import datetime
+import tempfile
+import threading
+import shutil
+import time
+import uuid
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
 from io import BytesIO
+from urllib.parse import quote
 
 import boto3
 import botocore
-from flask import Flask, redirect, request, jsonify
+from botocore.config import Config
+import click
+from flask import Flask, Response, redirect, request, jsonify, has_request_context, send_file
 from flask.views import MethodView
 from flask_httpauth import HTTPBasicAuth
 from lupa import LuaRuntime
-from werkzeug.utils import cached_property
 
 app = Flask(__name__)
 auth = HTTPBasicAuth()
@@ -27,13 +40,58 @@ ROCKS_UPLOAD_BUCKET = os.environ.get("ROCKS_UPLOAD_BUCKET")
 USER = os.environ.get("USERNAME")
 PASSWORD = os.environ.get("PASSWORD")
 PORT = os.environ.get("PORT", 5000)
+UPLOADS_PER_WORKER = int(os.environ.get("UPLOADS_PER_WORKER", 2))
+UPLOADS_PER_NODE = int(os.environ.get("UPLOADS_PER_NODE", 0))
+UPLOAD_QUEUE_SIZE = int(os.environ.get("UPLOAD_QUEUE_SIZE", 6))
+UPLOAD_QUEUE_TIMEOUT = float(os.environ.get("UPLOAD_QUEUE_TIMEOUT", 30))
+UPLOAD_RETRY_AFTER = int(os.environ.get("UPLOAD_RETRY_AFTER", 5))
+UPLOAD_SLOTS_DIR = os.environ.get("UPLOAD_SLOTS_DIR",
+                                  os.path.join(tempfile.gettempdir(), 'rocks-upload-slots'))
+JOURNAL_DIR = os.environ.get("JOURNAL_DIR",
+                             os.path.join(tempfile.gettempdir(), 'rocks-journal'))
+JOURNAL_RETRY_DELAY = float(os.environ.get("JOURNAL_RETRY_DELAY", 1))
+JOURNAL_MAX_RETRY_DELAY = float(os.environ.get("JOURNAL_MAX_RETRY_DELAY", 300))
+JOURNAL_MAX_ATTEMPTS = int(os.environ.get("JOURNAL_MAX_ATTEMPTS", 10))
+UPDATE_ATTEMPTS = int(os.environ.get("UPDATE_ATTEMPTS", 10))
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get("S3_MAX_POOL_CONNECTIONS", 32))
+ROCKS_CACHE_DIR = os.environ.get("ROCKS_CACHE_DIR", '')
+ROCKS_CACHE_SIZE = int(os.environ.get("ROCKS_CACHE_SIZE", 1024 ** 3))
+ROCKS_CACHE_SCM_TTL = float(os.environ.get("ROCKS_CACHE_SCM_TTL", 60))
+MANIFEST_SNAPSHOTS = int(os.environ.get("MANIFEST_SNAPSHOTS", 10))
+MANIFEST_POINTER_TTL = int(os.environ.get("MANIFEST_POINTER_TTL", 60))
+MANIFEST_COMPILE_DELAY = float(os.environ.get("MANIFEST_COMPILE_DELAY", 2))
+AUDIT_PAGE_SIZE = 100
+# Audit records are read by this many threads
+AUDIT_READ_WORKERS = 16
 TARANTOOL_IO_REDIRECT_URL = "https://www.tarantool.io/en/download/rocks"
 MANIFEST_TARGETS = ['manifest-5.1']
 MANIFEST = 'manifest'
+DEPENDENCY_INDEX = 'dependencies.json'
+CHECKSUM_INDEX = 'checksums.json'
+PACKAGES_FOLDER = 'packages/'
+SNAPSHOTS_FOLDER = 'manifests/'
+SHARDS_FOLDER = 'shards/'
+CHECKSUMS_FOLDER = 'checksums/'
+DEPENDENCIES_FOLDER = 'dependencies/'
+COMPILED_FOLDER = 'compiled/'
+EMPTY_MANIFEST = 'commands = {}\nmodules = {}\nrepository = {}\n'
+# Written once shards of all packages of the manifest are stored
+SHARDS_MIGRATED = f'{COMPILED_FOLDER}shards-migrated'
+MANIFEST_POINTER = 'manifest.current'
+SNAPSHOT_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# Objects read on every upload, revalidated with If-None-Match
+CACHED_OBJECTS = (MANIFEST, MANIFEST_POINTER, CHECKSUM_INDEX, DEPENDENCY_INDEX)
+INDEX_JSON = 'index.json'
+INDEX_HTML = 'index.html'
+AUDIT_RECORDS_FOLDER = 'audit/'
+# Markers indexing audit records of a month by package
+AUDIT_PACKAGES_FOLDER = 'packages/'
 
 MANIFEST_SCRIPT = 'make_manifest.lua'
+ROCK_INFO_SCRIPT = 'rock_info.lua'
 
 supported_files_pattern = re.compile(r'.*(.rockspec|.src.rock|.all.rock)$')
+snapshot_name_pattern = re.compile(r'^manifest-[0-9a-f]{64}$')
 
 
 def md5(f_obj):
@@ -45,6 +103,16 @@ def md5(f_obj):
     return hash_md5.hexdigest()
 
 
+def checksums(data: bytes) -> dict:
+    """ Computes the checksum index entry of an uploaded file.
+    """
+    return {
+        'md5': hashlib.md5(data).hexdigest(),
+        'sha256': hashlib.sha256(data).hexdigest(),
+        'size': len(data),
+    }
+
+
 def int2byte(x):
     return bytes((x,))
 
@@ -77,11 +145,12 @@ def istextfile(fileobj, blocksize=512):
 class InvalidUsage(RuntimeError):
     status_code = 400
 
-    def __init__(self, message, status_code=None):
+    def __init__(self, message, status_code=None, headers=None):
         RuntimeError.__init__(self)
         self.message = message
         if status_code is not None:
             self.status_code = status_code
+        self.headers = headers or {}
 
     def to_dict(self):
         rv = {'message': self.message}
@@ -91,10 +160,21 @@ class InvalidUsage(RuntimeError):
         return self.message
 
 
+class RockRejected(InvalidUsage):
+    """ The manifest refuses the rock, retrying won't help.
+    """
+
+
+class WriteConflict(RuntimeError):
+    """ The object was changed by someone else since it was read.
+    """
+
+
 @app.errorhandler(InvalidUsage)
 def handle_invalid_usage(error):
     response = jsonify(error.to_dict())
     response.status_code = error.status_code
+    response.headers.extend(error.headers)
     return response
 
 
@@ -109,6 +189,9 @@ def verify_password(user, password):
     return USER == user and PASSWORD == password
 
 
+startup_timings = {}
+_lua_started = time.monotonic()
+
 lua = LuaRuntime(unpack_returned_tuples=True)
 
 with open(MANIFEST_SCRIPT, 'r') as file:
@@ -121,6 +204,879 @@ def patch_manifest(manifest: str, filename: str, rock_content: str = '', action:
     return patch_manifest_func(manifest, filename, rock_content, action)
 
 
+with open(ROCK_INFO_SCRIPT, 'r') as file:
+    rock_info = lua.eval(file.read())
+
+startup_timings['lua'] = time.monotonic() - _lua_started
+
+
+def manifest_repository(manifest: str) -> dict:
+    """ Returns the manifest repository as {package: {version: [arch, ...]}}.
+    """
+    repository = {}
+    for package, versions in rock_info.repository(manifest).items():
+        repository[package] = {ver: list(arches.values())
+                               for ver, arches in versions.items()}
+    return repository
+
+
+def rockspec_dependencies(rockspec: str):
+    """ Returns the list of dependency strings declared by a rockspec or
+        None if the rockspec can't be evaluated.
+    """
+    package, version, dependencies = rock_info.rockspec(rockspec)
+    if dependencies is None:
+        return None
+    return list(dependencies.values())
+
+
+def rock_dependencies(file_name: str, package: bytes):
+    """ Extracts the dependency list of an uploaded file. Binary rocks are
+        zip archives carrying their rockspec at the top level.
+    """
+    if file_name.endswith('.rockspec'):
+        return rockspec_dependencies(package.decode('utf-8', errors='replace'))
+
+    rockspec_name = re.sub(r'\.[^.]+\.rock$', '.rockspec', file_name)
+    try:
+        with zipfile.ZipFile(BytesIO(package)) as archive:
+            rockspec = archive.read(rockspec_name)
+    except (zipfile.BadZipFile, KeyError):
+        return None
+    return rockspec_dependencies(rockspec.decode('utf-8', errors='replace'))
+
+
+rock_file_pattern = re.compile(r'^(.+)-(.*?-\d)\.(rockspec|[^.]+\.rock)$')
+
+
+def parse_rock_file_name(file_name):
+    """ Splits a rock file name into (package, version), following the
+        same rules as make_manifest.lua.
+    """
+    match = rock_file_pattern.match(file_name)
+    if not match:
+        return None, None
+    return match.group(1), match.group(2)
+
+
+_version_deltas = {
+    'dev': 120000000,
+    'scm': 110000000,
+    'cvs': 100000000,
+    'rc': -1000,
+    'pre': -10000,
+    'beta': -100000,
+    'alpha': -1000000,
+}
+
+
+def parse_version(version: str) -> tuple:
+    """ Parses a rock version the way LuaRocks does. Returns a pair of
+        (components, revision), revision being None if it's not specified.
+    """
+    version = version.strip()
+    revision = None
+    main, sep, rev = version.rpartition('-')
+    if sep and rev.isdigit():
+        version, revision = main, int(rev)
+
+    components = []
+    for number, word in re.findall(r'(\d+)|([a-zA-Z]+)', version):
+        if number:
+            components.append(int(number))
+        else:
+            components.append(_version_deltas.get(word.lower(), -10000000))
+    return components, revision
+
+
+def compare_versions(a, b) -> int:
+    a_components, a_revision = a
+    b_components, b_revision = b
+    for i in range(max(len(a_components), len(b_components))):
+        ai = a_components[i] if i < len(a_components) else 0
+        bi = b_components[i] if i < len(b_components) else 0
+        if ai != bi:
+            return -1 if ai < bi else 1
+    if a_revision is not None and b_revision is not None and a_revision != b_revision:
+        return -1 if a_revision < b_revision else 1
+    return 0
+
+
+_constraint_operators = {
+    '': '==', '=': '==', '==': '==', '~=': '~=', '!=': '~=',
+    '>': '>', '<': '<', '>=': '>=', '<=': '<=', '~>': '~>',
+}
+
+# The grammar of LuaRocks dependency strings (luarocks.queries and
+# luarocks.core.vers): an optionally namespaced name followed by
+# constraints, commas between constraints are optional
+dependency_pattern = re.compile(
+    r'^\s*([a-zA-Z0-9._\-]*/?[a-zA-Z0-9][a-zA-Z0-9._\-]*)\s*([^/]*)$')
+constraint_pattern = re.compile(r'(@?)([<>=~!]*)\s*([a-zA-Z0-9._\-]+)[\s,]*')
+
+
+def parse_dependency(dependency: str):
+    """ Parses a dependency string such as "checks >= 3.1, < 4" into
+        (name, [(operator, parsed_version), ...]).
+    """
+    match = dependency_pattern.match(dependency)
+    if not match:
+        raise InvalidUsage(f'invalid dependency: {dependency}')
+    name, rest = match.group(1).lower(), match.group(2)
+
+    constraints = []
+    while rest:
+        constraint = constraint_pattern.match(rest)
+        operator = _constraint_operators.get(constraint.group(2)) if constraint else None
+        if operator is None:
+            raise InvalidUsage(f'invalid dependency: {dependency}')
+        constraints.append((operator, parse_version(constraint.group(3))))
+        rest = rest[constraint.end():]
+    return name, constraints
+
+
+def match_constraints(version, constraints) -> bool:
+    version = parse_version(version) if isinstance(version, str) else version
+    for operator, requested in constraints:
+        cmp = compare_versions(version, requested)
+        if operator == '~>':
+            components, revision = version
+            requested_components, requested_revision = requested
+            ok = all((components[i] if i < len(components) else 0) == ri
+                     for i, ri in enumerate(requested_components))
+            if ok and requested_revision is not None:
+                ok = requested_revision == revision
+        else:
+            ok = {
+                '==': cmp == 0,
+                '~=': cmp != 0,
+                '>': cmp > 0,
+                '<': cmp < 0,
+                '>=': cmp >= 0,
+                '<=': cmp <= 0,
+            }[operator]
+        if not ok:
+            return False
+    return True
+
+
+def is_dev_version(version: str) -> bool:
+    return re.match(r'^(scm|dev|cvs)-', version) is not None
+
+
+def best_version(versions, constraints=()):
+    """ Picks the highest version matching the constraints. Development
+        versions (scm, dev) are only chosen when nothing else matches.
+    """
+    candidates = [v for v in versions if match_constraints(v, constraints)]
+    stable = [v for v in candidates if not is_dev_version(v)]
+    candidates = stable or candidates
+    best = None
+    for v in candidates:
+        if best is None or compare_versions(parse_version(v), parse_version(best)) > 0:
+            best = v
+    return best
+
+
+def audit_package(file_name):
+    """ Returns the package name an audit record is indexed by.
+    """
+    if not file_name:
+        return None
+    if file_name.startswith(SHARDS_FOLDER):
+        return file_name[len(SHARDS_FOLDER):]
+    package, _ = parse_rock_file_name(file_name)
+    return package or file_name
+
+
+def audit_record_id(timestamp: datetime) -> str:
+    """ Returns a unique id of an audit record, ids sort by time.
+    """
+    return f'{audit_time_key(timestamp)}-{uuid.uuid4().hex[:8]}'
+
+
+def audit_time_key(timestamp: datetime) -> str:
+    return timestamp.astimezone(timezone.utc).strftime('%Y%m%dT%H%M%S%f')
+
+
+def parse_timestamp(value):
+    try:
+        timestamp = datetime.fromisoformat(value)
+    except ValueError:
+        raise InvalidUsage(f'invalid timestamp: {value}')
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp
+
+
+def months_between(since, until):
+    year, month = since.year, since.month
+    while (year, month) <= (until.year, until.month):
+        yield f'{year % 100:02d}-{month:02d}'
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+def sorted_versions(versions):
+    """ Sorts versions from the newest to the oldest.
+    """
+    return sorted(versions, key=functools.cmp_to_key(
+        lambda a, b: compare_versions(parse_version(a), parse_version(b))), reverse=True)
+
+
+def package_summary(page: dict) -> dict:
+    versions = page['versions']
+    uploaded = [entry['uploaded'] for arches in versions.values()
+                for entry in arches.values() if entry]
+    return {
+        'latest': best_version(versions.keys()),
+        'versions': len(versions),
+        'updated': max(uploaded) if uploaded else None,
+    }
+
+
+def render_index_page(index: dict) -> str:
+    rows = []
+    for name, summary in sorted(index['packages'].items()):
+        name = html.escape(name)
+        rows.append(f'<tr><td><a href="{PACKAGES_FOLDER}{name}.html">{name}</a></td>'
+                    f'<td>{html.escape(summary["latest"] or "")}</td>'
+                    f'<td>{summary["versions"]}</td>'
+                    f'<td>{html.escape(summary["updated"] or "")}</td></tr>')
+    return ('<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>Tarantool rocks</title></head>\n'
+            '<body><h1>Tarantool rocks</h1>\n'
+            '<p><a href="manifest">manifest</a> | <a href="index.json">index.json</a> | '
+            f'<a href="{CHECKSUM_INDEX}">{CHECKSUM_INDEX}</a></p>\n'
+            '<table><tr><th>Package</th><th>Latest</th><th>Versions</th><th>Updated</th></tr>\n'
+            + '\n'.join(rows) + '\n</table></body></html>\n')
+
+
+def render_package_page(page: dict) -> str:
+    name = html.escape(page['package'])
+    rows = []
+    for version in sorted_versions(page['versions']):
+        for arch, entry in sorted(page['versions'][version].items()):
+            entry = entry or {}
+            file_name = entry.get('file') or \
+                f'{page["package"]}-{version}.{"rockspec" if arch == "rockspec" else arch + ".rock"}'
+            file_name = html.escape(file_name)
+            rows.append(f'<tr><td>{html.escape(version)}</td><td>{html.escape(arch)}</td>'
+                        f'<td><a href="../{file_name}">{file_name}</a></td>'
+                        f'<td>{html.escape(entry.get("uploaded") or "")}</td>'
+                        f'<td><code>{entry.get("sha256") or ""}</code></td></tr>')
+    return (f'<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>{name}</title></head>\n'
+            f'<body><h1>{name}</h1>\n<p><a href="../index.html">all rocks</a> | '
+            f'<a href="{name}.json">{name}.json</a></p>\n'
+            '<table><tr><th>Version</th><th>Arch</th><th>File</th><th>Uploaded</th><th>SHA-256</th></tr>\n'
+            + '\n'.join(rows) + '\n</table></body></html>\n')
+
+
+def dependency_names(dependencies: list) -> list:
+    """ Returns names of the dependencies, skipping the ones that can't be
+        parsed, so a single bad rockspec never breaks the whole index.
+    """
+    names = []
+    for dependency in dependencies:
+        try:
+            names.append(parse_dependency(dependency)[0])
+        except InvalidUsage:
+            continue
+    return names
+
+
+def add_to_dependency_index(index: dict, package: str, version: str, dependencies: list) -> dict:
+    """ Records dependencies of package/version in the forward index and
+        refreshes the reverse index. Dependencies that can't be parsed are
+        kept in the forward index only.
+    """
+    forward = index.setdefault('forward', {})
+    reverse = index.setdefault('reverse', {})
+
+    for name in dependency_names(forward.get(package, {}).get(version, [])):
+        versions = reverse.get(name, {}).get(package, [])
+        if version in versions:
+            versions.remove(version)
+        if not versions:
+            reverse.get(name, {}).pop(package, None)
+        if not reverse.get(name):
+            reverse.pop(name, None)
+
+    forward.setdefault(package, {})[version] = dependencies
+    for name in dependency_names(dependencies):
+        versions = reverse.setdefault(name, {}).setdefault(package, [])
+        if version not in versions:
+            versions.append(version)
+            versions.sort()
+    return index
+
+
+def merge_checksums(data, changed: dict, removed: list) -> bytes:
+    """ Merges per-package checksums into the repository-wide index.
+    """
+    index = json.loads(data.decode('utf-8')) if data is not None else {}
+    for file_name in list(index):
+        if parse_rock_file_name(file_name)[0] in removed:
+            del index[file_name]
+    for sums in changed.values():
+        index.update(json.loads(sums.decode('utf-8')))
+    return json.dumps(index, sort_keys=True).encode('utf-8')
+
+
+def merge_dependencies(data, changed: dict, removed: list) -> bytes:
+    """ Merges per-package dependencies into the forward index and
+        recomputes the reverse one.
+    """
+    forward = json.loads(data.decode('utf-8')).get('forward', {}) if data is not None else {}
+    for package in removed:
+        forward.pop(package, None)
+    for package, versions in changed.items():
+        forward.setdefault(package, {}).update(json.loads(versions.decode('utf-8')))
+
+    index = {}
+    for package, versions in forward.items():
+        for version, dependencies in versions.items():
+            add_to_dependency_index(index, package, version, dependencies)
+    return json.dumps(index, sort_keys=True).encode('utf-8')
+
+
+def resolve_dependencies(repository: dict, forward: dict, package: str, version: str) -> dict:
+    """ Walks the dependency graph starting from package/version and pins
+        every transitive dependency to the highest available version
+        matching its constraints.
+    """
+    resolved = {}
+    missing = []
+    conflicts = []
+    unindexed = []
+
+    queue = deque([(package, version)])
+    while queue:
+        current_package, current_version = queue.popleft()
+        dependencies = forward.get(current_package, {}).get(current_version)
+        if dependencies is None:
+            unindexed.append(f'{current_package} {current_version}')
+            continue
+
+        for dependency in dependencies:
+            name, constraints = parse_dependency(dependency)
+            if name == 'lua':
+                continue
+            if name == package:
+                pinned = version
+            else:
+                pinned = resolved.get(name)
+            if pinned is not None:
+                if not match_constraints(pinned, constraints):
+                    conflicts.append({'required_by': f'{current_package} {current_version}',
+                                      'dependency': dependency, 'resolved': pinned})
+                continue
+
+            chosen = best_version(repository.get(name, {}).keys(), constraints)
+            if chosen is None:
+                missing.append({'required_by': f'{current_package} {current_version}',
+                                'dependency': dependency})
+                continue
+            resolved[name] = chosen
+            queue.append((name, chosen))
+
+    return {
+        'package': package,
+        'version': version,
+        'dependencies': resolved,
+        'missing': missing,
+        'conflicts': conflicts,
+        'unindexed': unindexed,
+    }
+
+
+_s3_client = None
+_s3_client_lock = threading.Lock()
+object_cache = {}
+
+
+def s3_client():
+    """ Returns the S3 client shared by all requests of the worker, so
+        connections are pooled instead of being opened per request.
+    """
+    global _s3_client
+    if _s3_client is None:
+        with _s3_client_lock:
+            if _s3_client is None:
+                _s3_client = boto3.client(
+                    's3',
+                    endpoint_url=S3_URL,
+                    aws_access_key_id=S3_ACCESS_KEY,
+                    aws_secret_access_key=S3_SECRET_KEY,
+                    region_name=S3_REGION,
+                    config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS)
+                )
+    return _s3_client
+
+
+manifest_pointer_cache = {}
+snapshot_cache = {}
+# Set once this process saw the SHARDS_MIGRATED marker
+shards_migrated = threading.Event()
+
+
+def snapshot_name(manifest: bytes) -> str:
+    return f'manifest-{hashlib.sha256(manifest).hexdigest()}'
+
+
+def compiled_sources_name(target: str, data: bytes) -> str:
+    return f'{COMPILED_FOLDER}{target}-{hashlib.sha256(data).hexdigest()}.json'
+
+
+class UploadGate:
+    """ Admission control for uploads. At most `per_worker` uploads run
+        concurrently in a worker process and at most `per_node` across all
+        workers sharing `slots_dir`. Up to `queue_size` more uploads may
+        wait for a slot, the rest are rejected with 429 right away.
+        Zero limits mean no limit.
+    """
+
+    def __init__(self, per_worker, per_node=0, queue_size=0, timeout=0,
+                 retry_after=UPLOAD_RETRY_AFTER, slots_dir=UPLOAD_SLOTS_DIR):
+        self.semaphore = threading.BoundedSemaphore(per_worker) if per_worker else None
+        self.capacity = per_worker + queue_size if per_worker else 0
+        self.per_node = per_node
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.slots_dir = slots_dir
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def reject(self):
+        return InvalidUsage('too many uploads in progress, retry later', 429,
+                            headers={'Retry-After': str(self.retry_after)})
+
+    def acquire_node_slot(self, deadline):
+        os.makedirs(self.slots_dir, exist_ok=True)
+        while True:
+            for i in range(self.per_node):
+                slot = open(os.path.join(self.slots_dir, f'slot-{i}.lock'), 'w')
+                try:
+                    fcntl.flock(slot, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    slot.close()
+                    continue
+                return slot
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(0.05)
+
+    @contextmanager
+    def admit(self):
+        with self.lock:
+            if self.capacity and self.pending >= self.capacity:
+                raise self.reject()
+            self.pending += 1
+
+        deadline = time.monotonic() + self.timeout
+        worker_slot = False
+        node_slot = None
+        try:
+            if self.semaphore is not None:
+                worker_slot = self.semaphore.acquire(timeout=self.timeout)
+                if not worker_slot:
+                    raise self.reject()
+            if self.per_node:
+                node_slot = self.acquire_node_slot(deadline)
+                if node_slot is None:
+                    raise self.reject()
+            yield
+        finally:
+            if node_slot is not None:
+                fcntl.flock(node_slot, fcntl.LOCK_UN)
+                node_slot.close()
+            if worker_slot:
+                self.semaphore.release()
+            with self.lock:
+                self.pending -= 1
+
+
+upload_gate = UploadGate(UPLOADS_PER_WORKER, UPLOADS_PER_NODE,
+                         UPLOAD_QUEUE_SIZE, UPLOAD_QUEUE_TIMEOUT)
+
+
+def check_download_lane(threads):
+    """ Raises if uploads admitted by `upload_gate` can occupy all of the
+        `threads` of a worker, leaving none for downloads.
+    """
+    if not upload_gate.capacity or threads <= upload_gate.capacity:
+        raise RuntimeError(
+            f'{threads} threads leave no room for downloads: up to '
+            f'{upload_gate.capacity or "unlimited"} uploads run or wait in a worker, '
+            f'set GUNICORN_THREADS above UPLOADS_PER_WORKER + UPLOAD_QUEUE_SIZE')
+
+
+def upload_lane(func):
+    """ Runs the view through the upload admission control so uploads
+        can't occupy every thread reserved for downloads.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with upload_gate.admit():
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def write_durably(path, data: bytes):
+    with open(path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Journal:
+    """ Local write-ahead journal of accepted uploads. Every upload is
+        written to disk before it's sent to S3 and removed only after both
+        the artifact and the manifest are stored, so an S3 failure never
+        loses an accepted rock. Pending entries are replayed in order by a
+        background thread with exponential backoff, including the entries
+        left over by a previous run. Entries the manifest refuses or
+        failing `max_attempts` times are moved to the quarantine
+        subdirectory, so they don't block the entries after them.
+    """
+
+    def __init__(self, path, retry_delay=JOURNAL_RETRY_DELAY,
+                 max_retry_delay=JOURNAL_MAX_RETRY_DELAY, max_attempts=JOURNAL_MAX_ATTEMPTS):
+        self.path = path
+        self.quarantine_path = os.path.join(path, 'quarantine')
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_attempts = max_attempts
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.thread_lock = threading.Lock()
+
+    @contextmanager
+    def record(self, file_name, package: bytes, is_text: bool, message: str):
+        """ Durably stores an upload and yields the locked entry path.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        name = f'{time.time_ns():020d}-{uuid.uuid4().hex}'
+        tmp_path = os.path.join(self.path, f'.{name}')
+        os.makedirs(tmp_path)
+
+        write_durably(os.path.join(tmp_path, 'payload'), package)
+        meta = {'file_name': file_name, 'is_text': is_text, 'message': message}
+        write_durably(os.path.join(tmp_path, 'meta.json'), json.dumps(meta).encode('utf-8'))
+
+        lock = open(os.path.join(tmp_path, 'lock'), 'w')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            entry = os.path.join(self.path, name)
+            os.rename(tmp_path, entry)
+            fsync_dir(self.path)
+            yield entry
+        finally:
+            lock.close()
+
+    @contextmanager
+    def lock(self, entry):
+        """ Yields True if the entry was locked by the caller and still
+            exists, False if another thread or worker is handling it.
+        """
+        try:
+            lock = open(os.path.join(entry, 'lock'), 'w')
+        except FileNotFoundError:
+            yield False
+            return
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            yield False
+            return
+        try:
+            yield os.path.exists(os.path.join(entry, 'meta.json'))
+        finally:
+            lock.close()
+
+    def entries(self):
+        if not os.path.isdir(self.path):
+            return []
+        return [os.path.join(self.path, name)
+                for name in sorted(os.listdir(self.path))
+                if not name.startswith('.') and name != 'quarantine']
+
+    @staticmethod
+    def load(entry):
+        with open(os.path.join(entry, 'meta.json'), 'rb') as f:
+            meta = json.loads(f.read().decode('utf-8'))
+        with open(os.path.join(entry, 'payload'), 'rb') as f:
+            package = f.read()
+        return meta, package
+
+    @staticmethod
+    def remove(entry):
+        os.remove(os.path.join(entry, 'meta.json'))
+        shutil.rmtree(entry, ignore_errors=True)
+
+    def fail(self, entry, meta, error, rejected=False):
+        """ Counts a failed attempt to commit the entry. Returns True if
+            the entry was quarantined.
+        """
+        meta['attempts'] = meta.get('attempts', 0) + 1
+        if not rejected and meta['attempts'] < self.max_attempts:
+            write_durably(os.path.join(entry, '.meta.json'), json.dumps(meta).encode('utf-8'))
+            os.replace(os.path.join(entry, '.meta.json'), os.path.join(entry, 'meta.json'))
+            return False
+
+        app.logger.error('journal entry %s of %s is quarantined after %d attempts: %s',
+                         os.path.basename(entry), meta['file_name'], meta['attempts'], error)
+        os.makedirs(self.quarantine_path, exist_ok=True)
+        os.rename(entry, os.path.join(self.quarantine_path, os.path.basename(entry)))
+        fsync_dir(self.path)
+        return True
+
+    def replay(self, commit):
+        """ Commits pending entries in order, stops at the first failure.
+            Returns True when nothing is left to replay.
+        """
+        for entry in self.entries():
+            with self.lock(entry) as locked:
+                if not locked:
+                    continue
+                meta, package = self.load(entry)
+                rejected = False
+                try:
+                    committed = commit(meta, package)
+                    error = 'the storage is unavailable'
+                except RockRejected as e:
+                    committed, error, rejected = False, str(e), True
+                except Exception as e:
+                    committed, error = False, str(e)
+                if committed:
+                    self.remove(entry)
+                    continue
+                app.logger.warning('journal replay of %s failed: %s', meta['file_name'], error)
+                if not self.fail(entry, meta, error, rejected):
+                    return False
+        return True
+
+    def run(self):
+        delay = self.retry_delay
+        while True:
+            if self.replay(S3View().commit_journal_entry):
+                delay = self.retry_delay
+                self.wakeup.wait(self.max_retry_delay)
+            else:
+                self.wakeup.wait(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+            self.wakeup.clear()
+
+    def start(self):
+        with self.thread_lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='journal', daemon=True)
+                self.thread.start()
+        self.wakeup.set()
+
+
+journal = Journal(JOURNAL_DIR)
+
+
+class ManifestCompiler:
+    """ Compiles the manifest and the repository-wide indexes from their
+        per-package parts in the background. Uploads only write the parts
+        of their package and schedule a compilation, which runs `delay`
+        seconds later, so a burst of uploads is compiled once. Readers are
+        served the last compiled manifest and never wait for compilation.
+        A zero delay compiles on every upload.
+    """
+
+    def __init__(self, delay=MANIFEST_COMPILE_DELAY):
+        self.delay = delay
+        self.due = 0
+        # Counts of scheduled changes and of changes compiled so far
+        self.scheduled = 0
+        self.compiled = 0
+        self.stale = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.thread_lock = threading.Lock()
+
+    def schedule(self):
+        with self.thread_lock:
+            self.scheduled += 1
+            if not self.stale.is_set():
+                self.due = time.monotonic() + self.delay
+                self.stale.set()
+            if self.delay > 0 and self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='manifest-compiler',
+                                               daemon=True)
+                self.thread.start()
+        if self.delay <= 0:
+            self.compile_if_stale()
+
+    def compile_if_stale(self):
+        """ Compiles the manifest if there are changes not compiled yet.
+            Callers that waited for another compilation don't compile again
+            unless changes were scheduled after they called. Failed
+            compilations are retried later.
+        """
+        pending = self.scheduled
+        if not self.stale.is_set():
+            return
+        with self.lock:
+            if not self.stale.is_set() or self.compiled >= pending:
+                return
+            with self.thread_lock:
+                self.stale.clear()
+                started = self.scheduled
+            try:
+                S3View().compile_indexes()
+                self.compiled = started
+            except Exception as e:
+                app.logger.warning('manifest compilation failed: %s', e)
+                with self.thread_lock:
+                    self.due = time.monotonic() + self.delay
+                    self.stale.set()
+
+    def run(self):
+        while True:
+            self.stale.wait()
+            remaining = self.due - time.monotonic()
+            if remaining > 0:
+                time.sleep(remaining)
+                continue
+            self.compile_if_stale()
+
+
+manifest_compiler = ManifestCompiler()
+
+
+class RockCache:
+    """ Read-through cache of rock files on the local disk limited to
+        `max_bytes`, least recently used files are evicted first. The cache
+        directory may be shared by all workers of a node: misses of the same
+        file are fetched once under one of LOCK_STRIPES file locks.
+        Development versions (scm, dev) can be re-uploaded, so they are
+        revalidated with If-None-Match after `scm_ttl` seconds and dropped
+        on upload.
+    """
+
+    LOCK_STRIPES = 64
+
+    def __init__(self, path, max_bytes, scm_ttl=ROCKS_CACHE_SCM_TTL):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.scm_ttl = scm_ttl
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self.total = self.scan()[1]
+
+    def file_path(self, name, suffix=''):
+        return os.path.join(self.path, os.path.basename(name) + suffix)
+
+    def lock_path(self, name):
+        # Python's hash() differs between workers, names are hashed stably
+        stripe = int.from_bytes(hashlib.md5(name.encode('utf-8')).digest()[:4], 'big')
+        return os.path.join(self.path, f'{stripe % self.LOCK_STRIPES:02d}.lock')
+
+    def scan(self):
+        files = []
+        for entry in os.scandir(self.path):
+            if entry.is_file() and not entry.name.endswith(('.meta', '.lock', '.tmp')):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.name))
+        return sorted(files), sum(size for _, size, _ in files)
+
+    def lookup(self, name):
+        try:
+            with open(self.file_path(name, '.meta'), 'r') as f:
+                meta = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if not os.path.exists(self.file_path(name)):
+            return None
+        return meta
+
+    def expired(self, name, meta):
+        _, version = parse_rock_file_name(name)
+        return bool(version) and is_dev_version(version) and \
+            time.time() - meta['fetched'] > self.scm_ttl
+
+    def get(self, name, fetch):
+        """ Returns (path, etag) of the cached file, fetching it with
+            fetch(name, fileobj, etag) -> etag on a miss or when it's
+            expired. fetch writes nothing and returns etag if the file
+            wasn't modified. Returns None if the file doesn't exist.
+        """
+        meta = self.lookup(name)
+        if meta is not None and not self.expired(name, meta):
+            try:
+                os.utime(self.file_path(name))
+                return self.file_path(name), meta['etag']
+            except FileNotFoundError:
+                # Evicted since the lookup, it's fetched again
+                pass
+
+        with open(self.lock_path(name), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # Another thread or worker could fill it while we waited
+            meta = self.lookup(name)
+            if meta is None or self.expired(name, meta):
+                meta = self.fill(name, fetch, meta)
+                if meta is None:
+                    return None
+        return self.file_path(name), meta['etag']
+
+    def fill(self, name, fetch, cached=None):
+        tmp_path = self.file_path(name, f'.{uuid.uuid4().hex}.tmp')
+        try:
+            with open(tmp_path, 'wb') as f:
+                etag = fetch(name, f, f'"{cached["etag"]}"' if cached else None)
+            if etag is None:
+                return None
+            meta = {'etag': etag.strip('"'), 'fetched': time.time()}
+            if cached is not None and meta['etag'] == cached['etag']:
+                # Not modified, only the time of the check is refreshed
+                size = 0
+            else:
+                size = os.path.getsize(tmp_path)
+                os.rename(tmp_path, self.file_path(name))
+            with open(self.file_path(name, '.meta'), 'w') as f:
+                json.dump(meta, f)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        with self.lock:
+            self.total += size
+            if self.total > self.max_bytes:
+                self.evict()
+        return meta
+
+    def evict(self):
+        # Other workers share the directory, so the real size is rescanned
+        files, self.total = self.scan()
+        for _, size, name in files:
+            if self.total <= self.max_bytes * 0.9:
+                break
+            self.invalidate(name)
+            self.total -= size
+
+    def invalidate(self, name):
+        for suffix in ('.meta', ''):
+            try:
+                os.remove(self.file_path(name, suffix))
+            except FileNotFoundError:
+                pass
+
+
+rock_cache = RockCache(ROCKS_CACHE_DIR, ROCKS_CACHE_SIZE) if ROCKS_CACHE_DIR else None
+
+
 def file_name_is_valid(name):
     if supported_files_pattern.match(name):
         error = None
@@ -135,15 +1091,9 @@ class S3View(MethodView):
     bucket = ROCKS_UPLOAD_BUCKET
     expires_in = 24 * 60 * 60
 
-    @cached_property
+    @property
     def client(self):
-        return boto3.client(
-            's3',
-            endpoint_url=S3_URL,
-            aws_access_key_id=S3_ACCESS_KEY,
-            aws_secret_access_key=S3_SECRET_KEY,
-            region_name=S3_REGION
-        )
+        return s3_client()
 
     def presign_get(self, filename):
         return self.client.generate_presigned_url(
@@ -156,19 +1106,25 @@ class S3View(MethodView):
         )
 
     @auth.login_required
+    @upload_lane
     def put(self):
-        manifest = self.download_manifest()
         file = request.files.get('rockspec')
 
         if not file:
             msg = 'package file was not found in request data'
-            self.audit_log(msg)
+            self.audit_log(msg, action='put', outcome='rejected')
             raise InvalidUsage(msg)
 
         file_name = file.filename
         error = file_name_is_valid(file_name)
         if error:
-            self.audit_log(error)
+            self.audit_log(error, action='put', file=file_name, outcome='rejected')
+            raise InvalidUsage(error)
+
+        name, _ = parse_rock_file_name(file_name)
+        if name is None:
+            error = 'filename parsing error'
+            self.audit_log(error, action='put', file=file_name, outcome='rejected')
             raise InvalidUsage(error)
 
         is_text = istextfile(file)
@@ -177,28 +1133,526 @@ class S3View(MethodView):
         package = file.read()
         rockspec = package if is_text else ''
 
-        message, patched_manifest = patch_manifest(manifest, file_name,
-                                                   rock_content=rockspec, action='add')
-
-        if patched_manifest:
-            self.upload_fileobj(BytesIO(package), file_name,
-                                f'put {file_name} - {message}')
-            self.upload_fileobj(BytesIO(str.encode(patched_manifest)),
-                                'manifest', 'update manifest')
+        try:
+            shard, etag = self.read_shard(name)
+        except InvalidUsage:
+            raise
+        except Exception as e:
+            # The rock is checked against the shard when the journal replays it
+            app.logger.warning('shard of %s could not be read: %s', name, e)
+            message, patched = 'rock was accepted', None
         else:
-            self.audit_log(f'manifest update error: {message}')
-            raise InvalidUsage(message)
+            message, patched_shard = patch_manifest(shard.decode('utf-8'), file_name,
+                                                    rock_content=rockspec, action='add')
+            if not patched_shard:
+                self.audit_log(f'manifest update error: {message}', action='put',
+                               file=file_name, outcome='rejected')
+                raise InvalidUsage(message)
+            patched = shard, etag, patched_shard.encode('utf-8')
+
+        with journal.record(file_name, package, is_text, message) as entry:
+            try:
+                committed = self.commit_upload(file_name, package, is_text, message, patched)
+            except Exception as e:
+                app.logger.warning('upload of %s failed: %s', file_name, e)
+                committed = False
+            if committed:
+                journal.remove(entry)
+
+        if not committed:
+            journal.start()
+            return response_message('rock was accepted and will be published '
+                                    'as soon as the storage is available', 202)
 
         return response_message(message)
 
-    def upload_fileobj(self, file_obj, file_path, message):
+    def commit_upload(self, file_name, package, is_text, message, patched=None):
+        """ Stores the artifact and only then the manifest shard referencing
+            it, the manifest itself is compiled from shards later.
+            `patched` is an optional (shard, etag, patched shard) triple
+            computed by the caller. Returns False if any of them wasn't
+            stored.
+        """
+        rockspec = package if is_text else ''
+        name, _ = parse_rock_file_name(file_name)
+        sums = checksums(package)
+        if patched is None:
+            # Replayed uploads are checked before the artifact is stored, so
+            # a rejected one never replaces a published file
+            shard, etag = self.read_shard(name)
+            msg, patched_shard = patch_manifest(shard.decode('utf-8'), file_name,
+                                                rock_content=rockspec, action='add')
+            if not patched_shard:
+                stored = self.download_json(f'{CHECKSUMS_FOLDER}{name}.json')
+                if stored.get(file_name) == sums:
+                    # An earlier attempt stored this rock and its shard and
+                    # failed after that, only the remaining steps are left
+                    self.finish_upload(file_name, package, sums, shard)
+                    return True
+                self.audit_log(f'upload of {file_name} rejected: {msg}', action='put',
+                               file=file_name, outcome='rejected')
+                raise RockRejected(msg)
+            patched = shard, etag, patched_shard.encode('utf-8')
+
+        if not self.upload_fileobj(BytesIO(package), file_name,
+                                   f'put {file_name} - {message}', sums['md5']):
+            return False
+        if rock_cache is not None:
+            # Only development versions can be uploaded again
+            rock_cache.invalidate(file_name)
+
+        # Checksums are published before the manifest makes the file visible
+        def add_checksums(data):
+            index = json.loads(data.decode('utf-8')) if data is not None else {}
+            if index.get(file_name) == sums:
+                return None
+            index[file_name] = sums
+            return json.dumps(index, sort_keys=True).encode('utf-8')
+
+        self.update_object(f'{CHECKSUMS_FOLDER}{name}.json', add_checksums,
+                           content_type='application/json')
+
+        def patch(shard):
+            if shard is None:
+                shard = self.initial_shard(name)
+            msg, patched_shard = patch_manifest(shard.decode('utf-8'), file_name,
+                                                rock_content=rockspec, action='add')
+            if not patched_shard:
+                # A concurrent upload or an earlier replay got there first
+                self.audit_log(f'manifest update of {file_name} skipped: {msg}',
+                               action='update', file=file_name, outcome='skipped')
+                return None
+            return patched_shard.encode('utf-8')
+
+        shard = self.update_object(f'{SHARDS_FOLDER}{name}', patch, 'update manifest', patched)
+        if shard is None:
+            return False
+        self.finish_upload(file_name, package, sums, shard)
+        return True
+
+    def finish_upload(self, file_name, package, sums, shard):
+        """ Runs the steps after the shard of an upload is stored: indexes
+            its dependencies, regenerates its page and schedules the
+            manifest compilation.
+        """
+        self.update_dependency_index(file_name, package)
+        try:
+            self.update_index_pages(file_name, sums, shard.decode('utf-8'))
+        except Exception as e:
+            # Pages are regenerated on the next upload of the package
+            app.logger.warning('index pages update for %s failed: %s', file_name, e)
+        manifest_compiler.schedule()
+
+    def read_shard(self, name):
+        """ Returns the manifest shard of a package and its ETag, which is
+            None if the shard wasn't stored yet.
+        """
+        shard, etag = self.read_object(f'{SHARDS_FOLDER}{name}')
+        if shard is None:
+            shard = self.initial_shard(name)
+        return shard, etag
+
+    def initial_shard(self, name):
+        """ Returns the shard a package without one starts with: an empty
+            one once migrate_shards stored shards of all packages, the
+            entries the package has in the manifest before that.
+        """
+        if not shards_migrated.is_set():
+            if self.read_object(SHARDS_MIGRATED)[0] is None:
+                manifest, _ = self.read_manifest()
+                _, shard = patch_manifest(manifest.decode('utf-8'), name, action='shard')
+                return shard.encode('utf-8')
+            shards_migrated.set()
+        return EMPTY_MANIFEST.encode('utf-8')
+
+    def migrate_shards(self, workers=S3_MAX_POOL_CONNECTIONS):
+        """ Stores shards of all packages of the manifest that don't have
+            one yet, so uploads of new packages no longer read the whole
+            manifest. Returns the number of packages.
+        """
+        _, shards = patch_manifest(self.download_manifest(), '', action='split')
+        shards = {name: shard.encode('utf-8') for name, shard in shards.items()}
+
+        def store(item):
+            name, shard = item
+            # Shards stored by uploads meanwhile are never older
+            self.update_object(f'{SHARDS_FOLDER}{name}',
+                               lambda data: shard if data is None else None)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(store, shards.items()))
+        self.client.put_object(Bucket=self.bucket, Key=f'{S3_ROCKS_FOLDER}{SHARDS_MIGRATED}',
+                               Body=b'')
+        return len(shards)
+
+    def compile_folder(self, target, prefix, merge, suffix='', content_type=None):
+        """ Compiles `target` from the objects `<prefix><name><suffix>`.
+            `merge(data, changed, removed)` gets the current target, the
+            changed objects as {name: content} and the names of deleted
+            ones and returns the new target. ETags of the objects a target
+            was compiled from are kept next to it in COMPILED_FOLDER, so any
+            process downloads only objects changed since then. Returns the
+            compiled target.
+        """
+        # (replaced target, sources) of the last attempt
+        attempt = []
+
+        def update(data):
+            sources = self.download_json(compiled_sources_name(target, data)) \
+                if data is not None else {}
+            # Listed after the target was read, so a part is never older
+            # than the one it's compiled from
+            listing = {key[len(prefix):len(key) - len(suffix)]: etag
+                       for key, etag in self.list_objects(prefix) if key.endswith(suffix)}
+            compiled = {name: etag for name, etag in sources.items() if name in listing}
+            removed = [name for name in sources if name not in listing]
+            changed = {}
+            stale = [name for name, etag in listing.items() if sources.get(name) != etag]
+            if stale:
+                workers = min(len(stale), S3_MAX_POOL_CONNECTIONS)
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    fetched = pool.map(lambda name: self.read_object(f'{prefix}{name}{suffix}'),
+                                       stale)
+                    for name, (content, etag) in zip(stale, fetched):
+                        if content is not None:
+                            changed[name], compiled[name] = content, etag
+            if data is not None and not changed and not removed:
+                return None
+
+            updated = merge(data, changed, removed)
+            attempt[:] = [data, compiled]
+            return updated if updated != data else None
+
+        data = self.update_object(target, update, content_type=content_type)
+        if attempt:
+            # Written only once the target is, so conflicting attempts
+            # leave nothing behind
+            replaced, compiled = attempt
+            self.client.put_object(Bucket=self.bucket,
+                                   Key=f'{S3_ROCKS_FOLDER}{compiled_sources_name(target, data)}',
+                                   Body=json.dumps(compiled, sort_keys=True).encode('utf-8'),
+                                   ContentType='application/json')
+            if replaced is not None and replaced != data:
+                self.client.delete_object(
+                    Bucket=self.bucket,
+                    Key=f'{S3_ROCKS_FOLDER}{compiled_sources_name(target, replaced)}')
+        return data
+
+    def compile_manifest(self):
+        """ Merges changed shards into the manifest and publishes its
+            snapshot. Packages without shards keep their manifest entries.
+        """
+        def merge(manifest, changed, removed):
+            if manifest is None:
+                raise InvalidUsage('manifest file was not found in the bucket')
+            shards = {name: shard.decode('utf-8') for name, shard in changed.items()}
+            shards.update((name, EMPTY_MANIFEST) for name in removed)
+            _, compiled = patch_manifest(manifest.decode('utf-8'), '', lua.table_from(shards),
+                                         action='merge')
+            return compiled.encode('utf-8')
+
+        self.compile_folder(MANIFEST, SHARDS_FOLDER, merge)
+        self.publish_snapshot()
+
+    def compile_indexes(self):
+        """ Compiles the manifest and the repository-wide indexes, checksums
+            are published before the manifest makes the files visible. Each
+            target is compiled even if the ones before it failed.
+        """
+        targets = [
+            (CHECKSUM_INDEX, lambda: self.compile_folder(
+                CHECKSUM_INDEX, CHECKSUMS_FOLDER, merge_checksums, '.json', 'application/json')),
+            (MANIFEST, self.compile_manifest),
+            (DEPENDENCY_INDEX, lambda: self.compile_folder(
+                DEPENDENCY_INDEX, DEPENDENCIES_FOLDER, merge_dependencies, '.json',
+                'application/json')),
+            (INDEX_JSON, self.compile_index_pages),
+        ]
+        failed = []
+        for target, compile_target in targets:
+            try:
+                compile_target()
+            except Exception as e:
+                app.logger.warning('compilation of %s failed: %s', target, e)
+                failed.append(target)
+        if failed:
+            raise RuntimeError(f'compilation of {", ".join(failed)} failed')
+
+    def rebuild_manifest(self, workers=S3_MAX_POOL_CONNECTIONS, dry_run=False):
+        """ Rebuilds the manifest and all shards from the rock files in the
+            bucket, for the case the manifest is lost or corrupted. Rockspecs
+            are downloaded by `workers` threads and checked the same way as
+            uploads. Returns {'packages': ..., 'files': ..., 'skipped':
+            {file: reason}}. Uploads committed while it runs may be lost.
+        """
+        files = {}
+        # Rocks are at the top level, the delimiter skips audit records,
+        # snapshots and other folders
+        for key, _ in self.list_objects('', delimiter='/'):
+            name, _ = parse_rock_file_name(key)
+            if name is not None:
+                files.setdefault(name, []).append(key)
+        stale_shards = [key[len(SHARDS_FOLDER):] for key, _ in self.list_objects(SHARDS_FOLDER)]
+
+        def fetch(key):
+            data, _ = self.read_object(key)
+            return data.decode('utf-8', errors='replace') if data is not None else None
+
+        shards, skipped = {}, {}
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            # Lua isn't thread-safe, so only downloads run in the pool
+            rockspecs = {key: pool.submit(fetch, key)
+                         for keys in files.values() for key in keys if key.endswith('.rockspec')}
+            for name in sorted(files):
+                shard = EMPTY_MANIFEST
+                for key in sorted(files[name]):
+                    rockspec = rockspecs.pop(key).result() if key in rockspecs else ''
+                    if rockspec is None:
+                        skipped[key] = 'file was not found'
+                        continue
+                    try:
+                        msg, patched = patch_manifest(shard, key, rock_content=rockspec,
+                                                      action='add')
+                    except Exception as e:
+                        msg, patched = str(e), None
+                    if patched is None:
+                        skipped[key] = msg
+                        continue
+                    shard = patched
+                if shard != EMPTY_MANIFEST:
+                    shards[name] = shard
+
+            _, manifest = patch_manifest(EMPTY_MANIFEST, '', lua.table_from(shards),
+                                         action='merge')
+            summary = {'packages': len(shards), 'files': sum(map(len, files.values())),
+                       'skipped': skipped}
+            if dry_run:
+                return summary
+
+            def write_shard(item):
+                name, shard = item
+                shard = shard.encode('utf-8')
+                self.update_object(f'{SHARDS_FOLDER}{name}',
+                                   lambda data: shard if data != shard else None)
+
+            list(pool.map(write_shard, shards.items()))
+            list(pool.map(lambda name: self.client.delete_object(
+                Bucket=self.bucket, Key=f'{S3_ROCKS_FOLDER}{SHARDS_FOLDER}{name}'),
+                [name for name in stale_shards if name not in shards]))
+        self.client.put_object(Bucket=self.bucket, Key=f'{S3_ROCKS_FOLDER}{SHARDS_MIGRATED}',
+                               Body=b'')
+
+        # The manifest is replaced with a single write, readers see either
+        # the old or the rebuilt one
+        manifest = manifest.encode('utf-8')
+        self.update_object(MANIFEST, lambda data: manifest if data != manifest else None)
+        self.publish_snapshot()
+        self.sync_package_pages(manifest_repository(manifest.decode('utf-8')), workers)
+        return summary
+
+    def publish_snapshot(self, snapshot=None):
+        """ Stores the current manifest as an immutable snapshot named by
+            its hash and points MANIFEST_POINTER to it. The last
+            MANIFEST_SNAPSHOTS snapshots are kept, and older ones too while
+            a redirect to them may still be cached. If `snapshot` is given
+            the pointer is moved to that existing snapshot instead.
+        """
+        dropped = []
+
+        def advance(data):
+            pointer = json.loads(data.decode('utf-8')) if data is not None else {'history': []}
+            dropped.clear()
+            now = datetime.now(timezone.utc)
+            # When snapshots stopped being current
+            superseded = pointer.get('superseded', {})
+            if snapshot is None:
+                # Re-read on every attempt, so the pointer never goes back
+                # to a manifest older than the one it points to
+                manifest, _ = self.read_manifest()
+                name = snapshot_name(manifest)
+                if pointer.get('snapshot') == name:
+                    return None
+                self.client.put_object(Bucket=self.bucket,
+                                       Key=f'{S3_ROCKS_FOLDER}{SNAPSHOTS_FOLDER}{name}',
+                                       Body=manifest, ContentType='text/plain; charset=utf-8',
+                                       CacheControl=SNAPSHOT_CACHE_CONTROL)
+                history = [name] + [n for n in pointer['history'] if n != name]
+            else:
+                name, history = snapshot, pointer['history']
+            if pointer.get('snapshot') not in (None, name):
+                superseded[pointer['snapshot']] = now.isoformat(timespec='seconds')
+            superseded.pop(name, None)
+
+            # Redirects to the previous snapshots may be cached by clients
+            # for MANIFEST_POINTER_TTL and by workers a few seconds more
+            cached = now.timestamp() - MANIFEST_POINTER_TTL - min(5, MANIFEST_POINTER_TTL) - 1
+            kept = history[:MANIFEST_SNAPSHOTS]
+            for n in history[MANIFEST_SNAPSHOTS:]:
+                if n in superseded and datetime.fromisoformat(superseded[n]).timestamp() > cached:
+                    kept.append(n)
+                else:
+                    dropped.append(n)
+            return json.dumps({
+                'snapshot': name,
+                'committed': now.isoformat(timespec='seconds'),
+                'history': kept,
+                'superseded': {n: t for n, t in superseded.items() if n in kept},
+            }, indent=1).encode('utf-8')
+
+        pointer = self.update_object(MANIFEST_POINTER, advance, content_type='application/json')
+        if pointer is not None:
+            manifest_pointer_cache['pointer'] = \
+                (time.monotonic() + min(5, MANIFEST_POINTER_TTL), json.loads(pointer.decode('utf-8')))
+        for name in dropped:
+            self.client.delete_object(Bucket=self.bucket,
+                                      Key=f'{S3_ROCKS_FOLDER}{SNAPSHOTS_FOLDER}{name}')
+
+    def manifest_pointer(self):
+        """ Returns the current manifest pointer, refreshed at most every
+            few seconds, or None if snapshots were never published.
+        """
+        expires, pointer = manifest_pointer_cache.get('pointer', (0, None))
+        if time.monotonic() >= expires:
+            pointer = self.download_json(MANIFEST_POINTER) or None
+            manifest_pointer_cache['pointer'] = \
+                (time.monotonic() + min(5, MANIFEST_POINTER_TTL), pointer)
+        return pointer
+
+    def read_snapshot(self, name):
+        """ Returns the content of a manifest snapshot or None if it doesn't
+            exist. The last snapshot read is kept in memory.
+        """
+        manifest = snapshot_cache.get(name)
+        if manifest is None:
+            manifest, _ = self.read_object(name, f'{S3_ROCKS_FOLDER}{SNAPSHOTS_FOLDER}')
+            if manifest is None:
+                return None
+            # Snapshots never change, keeping the latest one is always safe
+            snapshot_cache.clear()
+            snapshot_cache[name] = manifest
+        return manifest
+
+    def update_index_pages(self, file_name, sums, manifest):
+        """ Regenerates the page of the uploaded package, both as JSON and
+            HTML, so it can be served right from the bucket. The top-level
+            index is compiled from package pages in the background.
+        """
+        package, version = parse_rock_file_name(file_name)
+        if package is None:
+            return
+        arch = file_name[len(f'{package}-{version}.'):].replace('.rock', '')
+        manifest_versions = manifest_repository(manifest).get(package, {})
+        uploaded = datetime.now(timezone.utc).isoformat(timespec='seconds')
+
+        def update_package(data):
+            page = json.loads(data.decode('utf-8')) if data is not None else {
+                'package': package, 'versions': {}}
+            versions = page['versions']
+            for ver, arches in manifest_versions.items():
+                for a in arches:
+                    versions.setdefault(ver, {}).setdefault(a, None)
+            versions.setdefault(version, {})[arch] = dict(sums, file=file_name, uploaded=uploaded)
+            return json.dumps(page, sort_keys=True, indent=1).encode('utf-8')
+
+        page = json.loads(self.update_object(f'{PACKAGES_FOLDER}{package}.json', update_package,
+                                             content_type='application/json'))
+        self.write_page(f'{PACKAGES_FOLDER}{package}.html', render_package_page(page))
+
+    def sync_package_pages(self, repository, workers=S3_MAX_POOL_CONNECTIONS):
+        """ Makes package pages list exactly the versions of `repository`
+            after the manifest was rolled back or rebuilt, checksums and
+            upload times of the remaining files are kept.
+        """
+        pages = [key[len(PACKAGES_FOLDER):-len('.json')]
+                 for key, _ in self.list_objects(PACKAGES_FOLDER) if key.endswith('.json')]
+
+        def sync(name):
+            versions = repository.get(name)
+            if not versions:
+                for suffix in ('.json', '.html'):
+                    self.client.delete_object(
+                        Bucket=self.bucket, Key=f'{S3_ROCKS_FOLDER}{PACKAGES_FOLDER}{name}{suffix}')
+                return
+
+            changed = []
+
+            def update(data):
+                page = json.loads(data.decode('utf-8')) if data is not None else {
+                    'package': name, 'versions': {}}
+                synced = {ver: {arch: page['versions'].get(ver, {}).get(arch) for arch in arches}
+                          for ver, arches in versions.items()}
+                if synced == page['versions']:
+                    return None
+                page['versions'] = synced
+                changed.append(True)
+                return json.dumps(page, sort_keys=True, indent=1).encode('utf-8')
+
+            page = self.update_object(f'{PACKAGES_FOLDER}{name}.json', update,
+                                      content_type='application/json')
+            if changed:
+                self.write_page(f'{PACKAGES_FOLDER}{name}.html',
+                                render_package_page(json.loads(page.decode('utf-8'))))
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(sync, set(pages) | set(repository)))
+        self.compile_index_pages()
+
+    def compile_index_pages(self):
+        """ Compiles the top-level index of all packages from their pages.
+        """
+        changed = []
+
+        def merge(data, pages, removed):
+            changed.append(True)
+            index = json.loads(data.decode('utf-8')) if data is not None else {'packages': {}}
+            for name in removed:
+                index['packages'].pop(name, None)
+            for name, page in pages.items():
+                index['packages'][name] = package_summary(json.loads(page.decode('utf-8')))
+            return json.dumps(index, sort_keys=True, indent=1).encode('utf-8')
+
+        index = self.compile_folder(INDEX_JSON, PACKAGES_FOLDER, merge, '.json', 'application/json')
+        if changed:
+            self.write_page(INDEX_HTML, render_index_page(json.loads(index.decode('utf-8'))))
+
+    def write_page(self, filename, page: str):
+        self.client.put_object(Bucket=self.bucket, Key=f'{S3_ROCKS_FOLDER}{filename}',
+                               Body=page.encode('utf-8'), ContentType='text/html; charset=utf-8')
+
+    def commit_journal_entry(self, meta, package):
+        return self.commit_upload(meta['file_name'], package, meta['is_text'], meta['message'])
+
+    def upload_fileobj(self, file_obj, file_path, message, md5_hash=None):
         err = None
-        md5_hash = md5(file_obj)
+        if md5_hash is None:
+            md5_hash = md5(file_obj)
         try:
             self.client.upload_fileobj(file_obj, self.bucket, f'{S3_ROCKS_FOLDER}{file_path}')
         except Exception as e:
             err = str(e)
-        self.audit_log(f'Upload failure: {err} {message}' if err else message, md5_hash)
+        self.audit_log(f'Upload failure: {err} {message}' if err else message, md5_hash,
+                       action='upload', file=file_path, outcome='failure' if err else 'success')
+        return err is None
+
+    def update_dependency_index(self, file_name, package):
+        rock_package, rock_version = parse_rock_file_name(file_name)
+        dependencies = rock_dependencies(file_name, package)
+        if rock_package is None or dependencies is None:
+            return
+
+        def update(data):
+            versions = json.loads(data.decode('utf-8')) if data is not None else {}
+            if versions.get(rock_version) == dependencies:
+                return None
+            versions[rock_version] = dependencies
+            return json.dumps(versions, sort_keys=True).encode('utf-8')
+
+        key = f'{DEPENDENCIES_FOLDER}{rock_package}.json'
+        try:
+            self.update_object(key, update, content_type='application/json')
+        except (InvalidUsage, WriteConflict) as e:
+            self.audit_log(f'dependency index update error: {e}', action='update',
+                           file=key, outcome='failure')
 
     def get(self, path='/'):
         if path == '/':
@@ -212,9 +1666,52 @@ class S3View(MethodView):
         if path in MANIFEST_TARGETS:
             path = MANIFEST
 
+        if path == MANIFEST:
+            pointer = self.manifest_pointer()
+            if pointer:
+                response = redirect(f'/{SNAPSHOTS_FOLDER}{pointer["snapshot"]}')
+                response.headers['Cache-Control'] = f'public, max-age={MANIFEST_POINTER_TTL}'
+                return response
+
+        if rock_cache is not None and supported_files_pattern.match(path):
+            return self.serve_cached(path)
+
         url = self.presign_get(path)
         return redirect(url)
 
+    def serve_cached(self, filename):
+        # Another thread or worker can evict the file before it's opened,
+        # then it's fetched again
+        for attempt in range(UPDATE_ATTEMPTS):
+            cached = rock_cache.get(filename, self.fetch_object)
+            if cached is None:
+                raise InvalidUsage(f'{filename} was not found', 404)
+            path, etag = cached
+            try:
+                return send_file(path, download_name=filename, etag=etag, conditional=True)
+            except FileNotFoundError:
+                if attempt == UPDATE_ATTEMPTS - 1:
+                    raise
+
+    def fetch_object(self, filename, fileobj, etag=None):
+        """ Streams an object to fileobj, returns its ETag or None if the
+            object doesn't exist. Nothing is written if the object still
+            matches etag.
+        """
+        params = {'IfNoneMatch': etag} if etag else {}
+        try:
+            obj = self.client.get_object(Bucket=self.bucket, Key=f'{S3_ROCKS_FOLDER}{filename}',
+                                         **params)
+        except botocore.exceptions.ClientError as ex:
+            if ex.response['Error']['Code'] == 'NoSuchKey':
+                return None
+            elif ex.response['Error']['Code'] in ('304', 'NotModified') and etag:
+                return etag
+            raise ex
+        for chunk in iter(lambda: obj['Body'].read(64 * 1024), b''):
+            fileobj.write(chunk)
+        return obj['ETag']
+
     def object_exists(self, filename, folder=None):
         if filename == '':
             return False
@@ -240,40 +1737,446 @@ class S3View(MethodView):
 
         return True
 
-    def download_manifest(self):
-        if not self.object_exists('manifest'):
+    def read_object(self, filename, folder=None):
+        """ Returns the object content and its ETag or (None, None) if the
+            object doesn't exist.
+        """
+        if folder is None:
+            folder = S3_ROCKS_FOLDER
+
+        key = f'{folder}{filename}'
+        cached = object_cache.get(key) if filename in CACHED_OBJECTS else None
+        params = {'IfNoneMatch': cached[1]} if cached else {}
+        try:
+            obj = self.client.get_object(
+                Bucket=self.bucket,
+                Key=key,
+                **params
+            )
+        except botocore.exceptions.ClientError as ex:
+            if ex.response['Error']['Code'] == 'NoSuchKey':
+                return None, None
+            elif ex.response['Error']['Code'] in ('304', 'NotModified') and cached:
+                return cached
+            else:
+                raise ex
+
+        data, etag = obj['Body'].read(), obj.get('ETag')
+        if filename in CACHED_OBJECTS:
+            object_cache[key] = data, etag
+        return data, etag
+
+    def write_object(self, filename, data: bytes, etag, folder=None, content_type=None):
+        """ Uploads the object only if it wasn't changed since it was read
+            with the given ETag (or still doesn't exist if etag is None).
+        """
+        if folder is None:
+            folder = S3_ROCKS_FOLDER
+
+        params = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+        if content_type:
+            params['ContentType'] = content_type
+        try:
+            response = self.client.put_object(Bucket=self.bucket, Key=f'{folder}{filename}',
+                                              Body=data, **params)
+        except botocore.exceptions.ClientError as ex:
+            if ex.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                raise WriteConflict(f'{filename} was changed concurrently')
+            raise ex
+        if filename in CACHED_OBJECTS and response.get('ETag'):
+            object_cache[f'{folder}{filename}'] = data, response['ETag']
+
+    def update_object(self, filename, update, message=None, current=None, content_type=None,
+                      folder=None):
+        """ Read-modify-write of an object with optimistic locking: the
+            update function gets the current content (or None) and returns
+            the new one, it's re-applied on a fresh copy if the object was
+            changed concurrently. Returning None from update cancels the
+            write. `current` is an optional (content, etag, updated content)
+            triple already computed by the caller. Returns the object
+            content after the update. When message is given the write is
+            audited and upload errors are reported by returning None
+            instead of raising.
+        """
+        for _ in range(UPDATE_ATTEMPTS):
+            if current is None:
+                data, etag = self.read_object(filename, folder)
+                current = data, etag, update(data)
+            data, etag, updated = current
+            if updated is None:
+                return data
+
+            err = None
+            try:
+                self.write_object(filename, updated, etag, folder, content_type)
+            except WriteConflict:
+                current = None
+                continue
+            except Exception as e:
+                if message is None:
+                    raise
+                err = str(e)
+            if message is not None:
+                self.audit_log(f'Upload failure: {err} {message}' if err else message,
+                               md5(BytesIO(updated)), action='update', file=filename,
+                               outcome='failure' if err else 'success')
+            return updated if err is None else None
+
+        if message is not None:
+            self.audit_log(f'Upload failure: too many concurrent updates {message}',
+                           action='update', file=filename, outcome='failure')
+            return None
+        raise WriteConflict(f'too many concurrent updates of {filename}')
+
+    def list_objects(self, prefix, folder=None, start_after=None, delimiter=None):
+        """ Yields (key, etag) of all objects with the given prefix in key
+            order, keys are relative to the folder (S3_ROCKS_FOLDER by
+            default). Listing starts after the `start_after` key, with a
+            `delimiter` keys containing it after the prefix are skipped.
+        """
+        if folder is None:
+            folder = S3_ROCKS_FOLDER
+
+        params = {'Bucket': self.bucket, 'Prefix': f'{folder}{prefix}'}
+        if start_after:
+            params['StartAfter'] = f'{folder}{start_after}'
+        if delimiter:
+            params['Delimiter'] = delimiter
+        while True:
+            page = self.client.list_objects_v2(**params)
+            for obj in page.get('Contents', []):
+                yield obj['Key'][len(folder):], obj['ETag']
+            if not page.get('IsTruncated'):
+                return
+            params['ContinuationToken'] = page['NextContinuationToken']
+
+    def read_manifest(self):
+        manifest, etag = self.read_object(MANIFEST)
+        if manifest is None:
             raise InvalidUsage('manifest file was not found in the bucket')
-        manifest_io = BytesIO()
-        self.client.download_fileobj(self.bucket, f'{S3_ROCKS_FOLDER}manifest', manifest_io)
+        return manifest, etag
+
+    def download_manifest(self):
+        return self.read_manifest()[0].decode('utf-8')
+
+    def download_json(self, filename, default=None):
+        data, _ = self.read_object(filename)
+        if data is None:
+            return {} if default is None else default
+        return json.loads(data.decode('utf-8'))
+
+    def audit_log(self, event: str, md5_hash='', action='', file=None, outcome='success'):
+        if has_request_context():
+            remote_addr, headers = request.remote_addr, dict(request.headers)
+            user = request.authorization.username if request.authorization else None
+        else:
+            remote_addr, headers, user = 'journal', {}, None
 
-        return manifest_io.getvalue().decode('utf-8')
+        now = datetime.now(timezone.utc)
+        try:
+            self.store_audit_record({
+                'id': audit_record_id(now),
+                'timestamp': now.isoformat(),
+                'action': action,
+                'file': file,
+                'md5': md5_hash or None,
+                'remote_addr': remote_addr,
+                'user': user,
+                'outcome': outcome,
+                'message': event,
+            })
+        except Exception as e:
+            # Structured records are best-effort, they never fail the upload
+            app.logger.warning('audit record of %s could not be stored: %s', file, e)
 
-    def audit_log(self, event: str, md5_hash=''):
         if md5_hash:
             md5_hash = f' md5hash: {md5_hash} |'
         log_data = f'{datetime.now()} | {event} |{md5_hash} ' \
-                   f'{request.remote_addr} | {json.dumps(dict(request.headers))}\n'
+                   f'{remote_addr} | {json.dumps(headers)}\n'
 
-        audit_file_name = f'{datetime.today().strftime("%y-%m")}.log'
-        audit_file = BytesIO()
+        # The monthly log is appended with a conditional write, so concurrent
+        # events don't lose lines, and like records it never fails the upload
+        line = log_data.encode()
+        try:
+            self.update_object(f'{datetime.today().strftime("%y-%m")}.log',
+                               lambda data: (data or b'') + line, folder=S3_AUDIT_FOLDER)
+        except Exception as e:
+            app.logger.warning('audit log of %s could not be updated: %s', file, e)
+
+    def store_audit_record(self, record):
+        """ Stores a structured audit record as a separate object
+            audit/<yy-mm>/<id>.json, so concurrent events never update a
+            shared object. Record ids start with the time, so a listing of
+            the month is in time order. An empty marker
+            audit/<yy-mm>/packages/<package>/<id> indexes it by package.
+        """
+        folder = f'{S3_AUDIT_FOLDER}{AUDIT_RECORDS_FOLDER}{record["timestamp"][2:7]}/'
+        self.write_object(f'{record["id"]}.json', json.dumps(record, sort_keys=True).encode('utf-8'),
+                          None, folder=folder, content_type='application/json')
+        package = audit_package(record['file'])
+        if package:
+            self.write_object(f'{AUDIT_PACKAGES_FOLDER}{quote(package, safe="")}/{record["id"]}',
+                              b'', None, folder=folder)
+
+    def list_audit_records(self, month, package=None, start_after=''):
+        """ Yields ids of audit records of the month in time order, only of
+            the given package if any, starting after the `start_after` id.
+        """
+        folder = f'{AUDIT_RECORDS_FOLDER}{month}/'
+        if package:
+            prefix = f'{folder}{AUDIT_PACKAGES_FOLDER}{quote(package, safe="")}/'
+            suffix = ''
+        else:
+            prefix, suffix = folder, '.json'
+        # The delimiter keeps package markers out of the month listing
+        for key, _ in self.list_objects(prefix, S3_AUDIT_FOLDER, f'{prefix}{start_after}',
+                                        delimiter='/'):
+            record_id = key[len(prefix):len(key) - len(suffix)]
+            if key.endswith(suffix) and record_id > start_after:
+                yield record_id
+
+    def read_audit_record(self, month, record_id):
+        data, _ = self.read_object(f'{record_id}.json',
+                                   f'{S3_AUDIT_FOLDER}{AUDIT_RECORDS_FOLDER}{month}/')
+        return json.loads(data.decode('utf-8')) if data is not None else None
+
+
+ready = threading.Event()
+_warm_up_lock = threading.Lock()
 
-        exists = self.object_exists(audit_file_name, S3_AUDIT_FOLDER)
-        if exists:
-            self.client.download_fileobj(self.bucket, f'{S3_AUDIT_FOLDER}{audit_file_name}', audit_file)
 
-        initial_size = audit_file.getbuffer().nbytes
+def warm_up():
+    """ Makes the worker ready to serve: opens pooled S3 connections and
+        loads the manifest pointer and the current snapshot into the caches
+        `/manifest` is served from. The Lua engine is compiled at import
+        time. Returns True if the worker is ready.
+    """
+    with _warm_up_lock:
+        if ready.is_set():
+            return True
+        try:
+            started = time.monotonic()
+            view = S3View()
+            view.client
+            startup_timings['s3_client'] = time.monotonic() - started
+
+            started = time.monotonic()
+            pointer = view.manifest_pointer()
+            if pointer is None:
+                # Snapshots were never published, the manifest is served as is
+                view.read_manifest()
+            elif view.read_snapshot(pointer['snapshot']) is None:
+                raise InvalidUsage(f'snapshot {pointer["snapshot"]} was not found')
+            startup_timings['manifest'] = time.monotonic() - started
+        except Exception as e:
+            app.logger.warning('warm-up failed: %s', e)
+            return False
+        ready.set()
+        app.logger.info('worker is ready: %s', ', '.join(
+            f'{step} {seconds * 1000:.0f}ms' for step, seconds in startup_timings.items()))
+        return True
 
-        audit_file.seek(0, io.SEEK_END)
-        audit_file.write(log_data.encode())
-        audit_file.seek(0)
 
-        if not exists or (exists and audit_file.getbuffer().nbytes > initial_size):
-            self.client.upload_fileobj(audit_file, self.bucket, f'{S3_AUDIT_FOLDER}{audit_file_name}')
+@app.route('/healthz')
+def healthz():
+    return jsonify({'status': 'ok'})
+
+
+@app.route('/readyz')
+def readyz():
+    # Retries a failed warm-up, so the worker gets ready once S3 is back
+    if not ready.is_set() and not warm_up():
+        response = jsonify({'status': 'starting'})
+        response.status_code = 503
+        return response
+    return jsonify({
+        'status': 'ready',
+        'timings': {step: round(seconds, 4) for step, seconds in startup_timings.items()},
+    })
+
+
+class ResolveView(S3View):
+
+    def get(self):
+        package = request.args.get('package')
+        if not package:
+            raise InvalidUsage('package argument is required')
+
+        repository = manifest_repository(self.download_manifest())
+        versions = repository.get(package)
+        if not versions:
+            raise InvalidUsage(f'package {package} was not found in manifest', 404)
+
+        version = request.args.get('version') or best_version(versions.keys())
+        if version not in versions:
+            raise InvalidUsage(f'version {version} of {package} was not found in manifest', 404)
+
+        index = self.download_json(DEPENDENCY_INDEX)
+        return jsonify(resolve_dependencies(repository, index.get('forward', {}),
+                                            package, version))
+
+
+class ChecksumView(S3View):
+
+    def get(self):
+        file_name = request.args.get('file')
+        if not file_name:
+            return jsonify(self.download_json(CHECKSUM_INDEX))
+
+        # Checksums of the package are up to date even before compilation
+        package, _ = parse_rock_file_name(file_name)
+        index = self.download_json(f'{CHECKSUMS_FOLDER}{package}.json') if package else {}
+        if file_name not in index:
+            index = self.download_json(CHECKSUM_INDEX)
+        if file_name not in index:
+            raise InvalidUsage(f'checksums of {file_name} were not found', 404)
+        return jsonify(index[file_name])
+
+
+class AuditView(S3View):
+
+    @auth.login_required
+    def get(self):
+        """ Returns audit records filtered by package, time range (since,
+            until) and outcome, oldest first. Pass the returned `next` value
+            as `page` to get the next page.
+        """
+        package = request.args.get('package')
+        outcome = request.args.get('outcome')
+        now = datetime.now(timezone.utc)
+        until = parse_timestamp(request.args['until']) if 'until' in request.args else now
+        since = parse_timestamp(request.args['since']) if 'since' in request.args else \
+            now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        try:
+            limit = max(1, min(int(request.args.get('limit', AUDIT_PAGE_SIZE)), 1000))
+        except ValueError:
+            raise InvalidUsage('limit must be a number')
+
+        page_month, page_id = '', ''
+        if request.args.get('page'):
+            page_month, _, page_id = request.args['page'].partition(':')
+        since_key, until_key = audit_time_key(since), audit_time_key(until)
+
+        def matching(pool):
+            for month in months_between(since, until):
+                if month < page_month:
+                    continue
+                # Record ids start with the time, so listing starts right at
+                # `since` or the page cursor and stops at `until`
+                start_after = since_key
+                if month == page_month:
+                    start_after = max(start_after, page_id)
+                ids = []
+                for record_id in self.list_audit_records(month, package, start_after):
+                    if record_id[:len(until_key)] > until_key:
+                        break
+                    ids.append(record_id)
+                    if len(ids) == limit:
+                        yield from read(pool, month, ids)
+                        ids = []
+                yield from read(pool, month, ids)
+
+        def read(pool, month, ids):
+            for record in pool.map(lambda record_id: self.read_audit_record(month, record_id), ids):
+                if record is None or outcome and record['outcome'] != outcome:
+                    continue
+                yield dict(record, month=month)
+
+        records = []
+        next_page = None
+        with ThreadPoolExecutor(max_workers=AUDIT_READ_WORKERS) as pool:
+            for record in matching(pool):
+                if len(records) == limit:
+                    next_page = f'{records[-1]["month"]}:{records[-1]["id"]}'
+                    break
+                records.append(record)
+
+        return jsonify({'records': records, 'next': next_page})
+
+
+class SnapshotView(S3View):
+
+    def get(self, name):
+        if not snapshot_name_pattern.match(name):
+            raise InvalidUsage(f'{name} is not a manifest snapshot', 404)
+
+        manifest = self.read_snapshot(name)
+        if manifest is None:
+            raise InvalidUsage(f'snapshot {name} was not found', 404)
+
+        response = Response(manifest, mimetype='text/plain')
+        response.headers['Cache-Control'] = SNAPSHOT_CACHE_CONTROL
+        response.set_etag(name[len('manifest-'):])
+        return response.make_conditional(request)
+
+
+@app.cli.command('rollback-manifest')
+@click.argument('snapshot', required=False)
+def rollback_manifest(snapshot):
+    """ Restores the manifest from a snapshot, the previous one by default.
+    """
+    view = S3View()
+    pointer = view.download_json(MANIFEST_POINTER)
+    history = pointer.get('history', [])
+    if snapshot is None:
+        current = history.index(pointer['snapshot']) if pointer.get('snapshot') in history else -1
+        if current + 1 >= len(history):
+            raise click.ClickException('there is no previous snapshot')
+        snapshot = history[current + 1]
+    if snapshot not in history:
+        raise click.ClickException(f'snapshot {snapshot} was not found, known snapshots: '
+                                   f'{", ".join(history)}')
+
+    manifest, _ = view.read_object(snapshot, f'{S3_ROCKS_FOLDER}{SNAPSHOTS_FOLDER}')
+    # The manifest is the base of the next uploads, so it's restored too
+    view.update_object(MANIFEST, lambda data: manifest if data != manifest else None)
+    # So are the shards, otherwise the next compilation brings the entries back
+    for name in [key[len(SHARDS_FOLDER):] for key, _ in view.list_objects(SHARDS_FOLDER)]:
+        _, shard = patch_manifest(manifest.decode('utf-8'), name, action='shard')
+        shard = shard.encode('utf-8')
+        view.update_object(f'{SHARDS_FOLDER}{name}', lambda data: shard if data != shard else None)
+    view.publish_snapshot(snapshot)
+    view.sync_package_pages(manifest_repository(manifest.decode('utf-8')))
+    click.echo(f'manifest was rolled back to {snapshot}')
+
+
+@app.cli.command('migrate-shards')
+@click.option('--workers', default=S3_MAX_POOL_CONNECTIONS, show_default=True,
+              help='Number of parallel uploads.')
+def migrate_shards(workers):
+    """ Stores manifest shards of all packages, once after an upgrade.
+    """
+    started = time.monotonic()
+    packages = S3View().migrate_shards(workers)
+    click.echo(f'stored shards of {packages} packages in {time.monotonic() - started:.1f}s')
+
+
+@app.cli.command('rebuild-manifest')
+@click.option('--workers', default=S3_MAX_POOL_CONNECTIONS, show_default=True,
+              help='Number of parallel downloads.')
+@click.option('--dry-run', is_flag=True, help="Only report what would be rebuilt.")
+def rebuild_manifest(workers, dry_run):
+    """ Rebuilds the manifest from the rock files in the bucket.
+    """
+    started = time.monotonic()
+    summary = S3View().rebuild_manifest(workers, dry_run)
+    for file_name, reason in sorted(summary['skipped'].items()):
+        click.echo(f'skipped {file_name}: {reason}', err=True)
+    click.echo(f'{"found" if dry_run else "rebuilt"} {summary["packages"]} packages from '
+               f'{summary["files"]} files in {time.monotonic() - started:.1f}s')
 
 
 s3_view = S3View.as_view('s3_view')
 app.add_url_rule('/<path>', view_func=s3_view, methods=['GET'])
 app.add_url_rule('/', view_func=s3_view, methods=['GET', 'PUT'])
+app.add_url_rule('/api/resolve', view_func=ResolveView.as_view('resolve_view'), methods=['GET'])
+app.add_url_rule('/api/checksums', view_func=ChecksumView.as_view('checksum_view'), methods=['GET'])
+app.add_url_rule('/api/audit', view_func=AuditView.as_view('audit_view'), methods=['GET'])
+app.add_url_rule(f'/{SNAPSHOTS_FOLDER}<name>', view_func=SnapshotView.as_view('snapshot_view'),
+                 methods=['GET'])
 
 if __name__ == '__main__':
+    warm_up()
+    journal.start()
+    manifest_compiler.schedule()
     app.run(port=PORT)
@@ -0,0 +1,22 @@
+import os
+
+# Uploads are throttled by app.UploadGate (UPLOADS_PER_WORKER running plus
+# UPLOAD_QUEUE_SIZE waiting per worker), so threads above that number are
+# always free to serve downloads even when many uploads arrive at once.
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 16))
+
+
+def post_worker_init(worker):
+    import app
+
+    # A misconfigured worker fails to boot instead of starving downloads
+    app.check_download_lane(worker.cfg.threads)
+    # Runs before the worker accepts connections, so the first requests
+    # don't pay for S3 connections and the manifest download
+    app.warm_up()
+    # Replay uploads journaled but not yet stored by a previous run
+    app.journal.start()
+    # Compile parts left uncompiled by a previous run, only the parts
+    # changed since the last compilation are downloaded
+    app.manifest_compiler.schedule()
@@ -208,10 +208,44 @@ function(manifest, filename, rock_content, action)
    end
 
 
+   local function serialize(manifest)
+      local out = {buffer = {}}
+      function out:write(data) table.insert(self.buffer, data) end
+      write_table_as_assignments(out, manifest)
+      return table.concat(out.buffer)
+   end
+
    local function patch_manifest(manifest, filename, rock_content, action)
       local result = eval_lua_string(manifest)
       local msg, package, ver, arch
 
+      if action == 'shard' then
+         -- filename is a package name here
+         return 'shard was successfully extracted from manifest', serialize({
+            commands = {},
+            modules = {},
+            repository = {[filename] = result.repository[filename]},
+         })
+      elseif action == 'split' then
+         -- returns shards of all packages as a table {package: shard}
+         local shards = {}
+         for name, versions in pairs(result.repository) do
+            shards[name] = serialize({
+               commands = {},
+               modules = {},
+               repository = {[name] = versions},
+            })
+         end
+         return 'manifest was successfully split into shards', shards
+      elseif action == 'merge' then
+         -- rock_content maps package names to their shards
+         for name, shard in pairs(rock_content) do
+            local repository = eval_lua_string(shard).repository or {}
+            result.repository[name] = repository[name]
+         end
+         return 'shards were successfully merged into manifest', serialize(result)
+      end
+
       if filename:match('.rockspec$') then
          package, ver, arch = filename:match('^(.+)-(.-%-%d)%.(rockspec)$')
       elseif filename:match('.rock$') then
@@ -281,11 +315,7 @@ function(manifest, filename, rock_content, action)
          return 'action is not supported', nil
       end
 
-      local out = {buffer = {}}
-      function out:write(data) table.insert(self.buffer, data) end
-      write_table_as_assignments(out, result)
-
-      return msg, table.concat(out.buffer)
+      return msg, serialize(result)
    end
 
    return patch_manifest(manifest, filename, rock_content, action)
@@ -0,0 +1,63 @@
+(function()
+   local function eval_lua_string(str, name)
+      local env = {}
+      str = str:gsub("^#![^\n]*\n", "")
+      local chunk
+      if _VERSION == "Lua 5.1" then
+         chunk = loadstring(str, name)
+         if chunk then
+            setfenv(chunk, env)
+         end
+      else
+         chunk = load(str, name, "t", env)
+      end
+      if not chunk or not pcall(chunk) then
+         return nil
+      end
+      return env
+   end
+
+   local info = {}
+
+   -- Returns the repository table of a manifest as
+   -- { [package] = { [version] = { arch, ... } } }.
+   function info.repository(manifest)
+      local result = eval_lua_string(manifest, "manifest")
+      local repository = {}
+      if result == nil or type(result.repository) ~= "table" then
+         return repository
+      end
+      for package, versions in pairs(result.repository) do
+         repository[package] = {}
+         for ver, entries in pairs(versions) do
+            local arches = {}
+            for _, entry in ipairs(entries) do
+               table.insert(arches, entry.arch)
+            end
+            repository[package][ver] = arches
+         end
+      end
+      return repository
+   end
+
+   -- Returns package, version and the list of dependency strings
+   -- declared by a rockspec.
+   function info.rockspec(rockspec)
+      local result = eval_lua_string(rockspec, "rockspec")
+      if result == nil then
+         return nil, nil, nil
+      end
+
+      local dependencies = {}
+      if type(result.dependencies) == "table" then
+         for _, dep in ipairs(result.dependencies) do
+            if type(dep) == "string" then
+               table.insert(dependencies, dep)
+            end
+         end
+      end
+      return result.package, result.version, dependencies
+   end
+
+   return info
+end)()
@@ -1,7 +1,9 @@
+import hashlib
 import logging
 import os.path
 import re
 import sys
+from io import BytesIO
 from textwrap import dedent
 
 import botocore as botocore
@@ -35,9 +37,20 @@ class S3Mock:
 
         return 'https://hb.bizmrd.ru/tarantool/%s' % key
 
-    def get_object(self, Bucket, Key):
+    @staticmethod
+    def etag(data):
+        return '"%s"' % hashlib.md5(data).hexdigest()
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        if Key in self.files and IfNoneMatch == self.etag(self.files[Key]):
+            raise botocore.exceptions.ClientError(
+                error_response={'Error': {'Code': '304'}},
+                operation_name='GetObject'
+            )
         if Key in self.files:
             return {
+                'Body': BytesIO(self.files[Key]),
+                'ETag': self.etag(self.files[Key]),
                 'ResponseMetadata': {'HTTPHeaders': ['content-type']}
             }
         else:
@@ -46,6 +59,19 @@ class S3Mock:
                 operation_name=None
             )
 
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None, ContentType=None,
+                   CacheControl=None):
+        exists = Key in self.files
+        if (IfMatch is not None and (not exists or self.etag(self.files[Key]) != IfMatch)) or \
+                (IfNoneMatch == '*' and exists):
+            raise botocore.exceptions.ClientError(
+                error_response={'Error': {'Code': 'PreconditionFailed'}},
+                operation_name='PutObject'
+            )
+        logging.info('PUT %s' % Key)
+        self.files[Key] = Body
+        return {'ETag': self.etag(Body)}
+
     def download_fileobj(self, Bucket, Key, Bytes):
         Bytes.write(self.files[Key])
 
@@ -53,9 +79,35 @@ class S3Mock:
         logging.info('PUT %s' % Key)
         self.files[Key] = Data.read()
 
+    def list_objects_v2(self, Bucket, Prefix='', ContinuationToken=None, MaxKeys=1000,
+                        StartAfter='', Delimiter=None):
+        keys = sorted(key for key in self.files
+                      if key.startswith(Prefix) and key > max(ContinuationToken or '', StartAfter))
+        entries = []
+        for key in keys:
+            rest = key[len(Prefix):]
+            if Delimiter and Delimiter in rest:
+                common_prefix = Prefix + rest[:rest.index(Delimiter) + len(Delimiter)]
+                if not entries or entries[-1] != ('prefix', common_prefix):
+                    entries.append(('prefix', common_prefix))
+            else:
+                entries.append(('key', key))
+        page = entries[:MaxKeys]
+        response = {
+            'Contents': [{'Key': key, 'ETag': self.etag(self.files[key])}
+                         for kind, key in page if kind == 'key'],
+            'CommonPrefixes': [{'Prefix': key} for kind, key in page if kind == 'prefix'],
+            'IsTruncated': len(entries) > MaxKeys,
+        }
+        if response['IsTruncated']:
+            kind, last = page[-1]
+            # Keys under a common prefix are skipped on the next page
+            response['NextContinuationToken'] = last + '\uffff' if kind == 'prefix' else last
+        return response
+
     def delete_object(self, Bucket, Key):
         logging.info('DELETE %s' % Key)
-        del self.files[Key]
+        self.files.pop(Key, None)
 
 
 def patch_manifest_func_mock(*args, **kwargs):
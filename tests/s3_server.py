@@ -0,0 +1,176 @@
+""" A tiny in-memory S3 stand-in for load tests.
+
+Implements the subset of the S3 REST API the rocks server uses (path-style
+GetObject, HeadObject, PutObject with If-Match/If-None-Match, DeleteObject
+and ListObjectsV2) and can delay every request to emulate a slow object
+store:
+
+    python tests/s3_server.py --port 9000 --latency 0.02 --jitter 0.01
+"""
+import argparse
+import hashlib
+import random
+import sys
+import threading
+import time
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+from xml.sax.saxutils import escape
+
+
+class Storage:
+    def __init__(self):
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def etag(data):
+        return '"%s"' % hashlib.md5(data).hexdigest()
+
+
+def decode_aws_chunked(body):
+    """ Strips aws-chunked framing (chunk sizes, signatures and trailers).
+    """
+    data = bytearray()
+    pos = 0
+    while True:
+        line_end = body.index(b'\r\n', pos)
+        size = int(body[pos:line_end].split(b';')[0], 16)
+        pos = line_end + 2
+        if size == 0:
+            return bytes(data)
+        data += body[pos:pos + size]
+        pos += size + 2
+
+
+class S3Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    storage = Storage()
+    latency = 0.0
+    jitter = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def delay(self):
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+
+    def split_path(self):
+        url = urlparse(self.path)
+        bucket, _, key = url.path.lstrip('/').partition('/')
+        return bucket, unquote(key), parse_qs(url.query)
+
+    def reply(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def error(self, status, code):
+        body = f'<?xml version="1.0" encoding="UTF-8"?>' \
+               f'<Error><Code>{code}</Code><Message>{code}</Message></Error>'
+        self.reply(status, body.encode(), {'Content-Type': 'application/xml'})
+
+    def read_body(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if 'aws-chunked' in self.headers.get('Content-Encoding', ''):
+            body = decode_aws_chunked(body)
+        return body
+
+    def do_GET(self):
+        self.delay()
+        bucket, key, query = self.split_path()
+        if not key and 'list-type' in query:
+            return self.list_objects(bucket, query)
+
+        with self.storage.lock:
+            data = self.storage.objects.get((bucket, key))
+        if data is None:
+            return self.error(404, 'NoSuchKey')
+        self.reply(200, data, {
+            'Content-Type': 'binary/octet-stream',
+            'ETag': self.storage.etag(data),
+            'Last-Modified': formatdate(usegmt=True),
+        })
+
+    do_HEAD = do_GET
+
+    def do_PUT(self):
+        self.delay()
+        bucket, key, _ = self.split_path()
+        body = self.read_body()
+        if_match = self.headers.get('If-Match')
+        if_none_match = self.headers.get('If-None-Match')
+
+        with self.storage.lock:
+            current = self.storage.objects.get((bucket, key))
+            if if_match is not None and (current is None or self.storage.etag(current) != if_match):
+                return self.error(412, 'PreconditionFailed')
+            if if_none_match == '*' and current is not None:
+                return self.error(412, 'PreconditionFailed')
+            self.storage.objects[(bucket, key)] = body
+        self.reply(200, headers={'ETag': self.storage.etag(body)})
+
+    def do_DELETE(self):
+        self.delay()
+        bucket, key, _ = self.split_path()
+        with self.storage.lock:
+            self.storage.objects.pop((bucket, key), None)
+        self.reply(204)
+
+    def list_objects(self, bucket, query):
+        prefix = query.get('prefix', [''])[0]
+        max_keys = int(query.get('max-keys', ['1000'])[0])
+        start_after = query.get('continuation-token', query.get('start-after', ['']))[0]
+
+        with self.storage.lock:
+            keys = sorted((key, len(data), self.storage.etag(data))
+                          for (b, key), data in self.storage.objects.items()
+                          if b == bucket and key.startswith(prefix) and key > start_after)
+        page, truncated = keys[:max_keys], len(keys) > max_keys
+
+        contents = ''.join(f'<Contents><Key>{escape(key)}</Key><Size>{size}</Size>'
+                           f'<ETag>{escape(etag)}</ETag></Contents>'
+                           for key, size, etag in page)
+        token = f'<NextContinuationToken>{escape(page[-1][0])}</NextContinuationToken>' \
+            if truncated else ''
+        body = f'<?xml version="1.0" encoding="UTF-8"?>' \
+               f'<ListBucketResult><Name>{escape(bucket)}</Name><Prefix>{escape(prefix)}</Prefix>' \
+               f'<KeyCount>{len(page)}</KeyCount><MaxKeys>{max_keys}</MaxKeys>' \
+               f'<IsTruncated>{"true" if truncated else "false"}</IsTruncated>' \
+               f'{contents}{token}</ListBucketResult>'
+        self.reply(200, body.encode(), {'Content-Type': 'application/xml'})
+
+
+class S3Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients dropping keep-alive connections are not errors
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def make_server(host='127.0.0.1', port=0, latency=0.0, jitter=0.0):
+    handler = type('Handler', (S3Handler,), {
+        'storage': Storage(), 'latency': latency, 'jitter': jitter,
+    })
+    return S3Server((host, port), handler)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every request')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='random extra delay up to this many seconds')
+    args = parser.parse_args()
+
+    make_server(args.host, args.port, args.latency, args.jitter).serve_forever()
@@ -0,0 +1,229 @@
+""" Concurrency stress test of the rocks server.
+
+Starts the app under gunicorn with a growing number of workers against the
+S3 stand-in from s3_server.py, fires concurrent uploads of several versions
+of the same packages mixed with downloads and checks that the final
+manifest contains every uploaded version. Uploads answered with 429 are
+retried after Retry-After. Prints throughput and p50/p99 latencies per
+worker count and exits with a non-zero code if any upload was lost or
+never accepted:
+
+    python tests/stress.py --workers 1 2 4 --uploads 2000 --latency 0.01
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import boto3
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from s3_server import make_server  # noqa
+
+BUCKET = 'rocks'
+FOLDER = 'stress/'
+USER = 'stress'
+PASSWORD = 'stress'
+EMPTY_MANIFEST = b'commands = {}\nmodules = {}\nrepository = {}\n'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'nothing is listening on port {port}')
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def rock(args, i):
+    """ Returns (package, version) of the i-th upload, every package gets
+        about `versions` versions.
+    """
+    return f'stress-{i % max(1, args.uploads // args.versions)}', f'{i}.0.0-1'
+
+
+class Run:
+    def __init__(self, args, workers):
+        self.args = args
+        self.workers = workers
+        self.put_latencies = []
+        self.get_latencies = []
+        self.statuses = {}
+        self.accepted = set()
+        self.lock = threading.Lock()
+
+    def record(self, latencies, started, status):
+        with self.lock:
+            latencies.append(time.monotonic() - started)
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def upload(self, session, url, i):
+        package, version = rock(self.args, i)
+        name = f'{package}-{version}.rockspec'
+        rockspec = f"package = '{package}'\nversion = '{version}'\n"
+        for _ in range(self.args.attempts):
+            started = time.monotonic()
+            try:
+                response = session.put(url, auth=(USER, PASSWORD),
+                                       files={'rockspec': (name, rockspec)})
+                status = response.status_code
+            except requests.RequestException as e:
+                response, status = None, type(e).__name__
+            self.record(self.put_latencies, started, status)
+            if status in (201, 202):
+                with self.lock:
+                    self.accepted.add((package, version))
+                return
+            retry_after = response.headers.get('Retry-After') if response is not None else None
+            time.sleep(min(float(retry_after or 1), self.args.max_retry_delay))
+
+    def download(self, session, url, i):
+        package, version = rock(self.args, i)
+        path = 'manifest' if i % 2 else f'{package}-{version}.rockspec'
+        started = time.monotonic()
+        try:
+            status = session.get(f'{url}/{path}', allow_redirects=False).status_code
+        except requests.RequestException as e:
+            status = type(e).__name__
+        self.record(self.get_latencies, started, status)
+
+
+def run(args, workers):
+    from app import manifest_repository
+
+    s3 = make_server(latency=args.latency, jitter=args.jitter)
+    threading.Thread(target=s3.serve_forever, daemon=True).start()
+    s3_url = f'http://127.0.0.1:{s3.server_port}'
+    client = boto3.client('s3', endpoint_url=s3_url, aws_access_key_id='stress',
+                          aws_secret_access_key='stress', region_name='us-east-1')
+    client.upload_fileobj(BytesIO(EMPTY_MANIFEST), BUCKET, f'{FOLDER}manifest')
+
+    port = free_port()
+    work_dir = tempfile.mkdtemp(prefix='rocks-stress-')
+    env = dict(os.environ,
+               S3_URL=s3_url, S3_ACCESS_KEY='stress', S3_SECRET_KEY='stress',
+               S3_REGION='us-east-1', ROCKS_UPLOAD_BUCKET=BUCKET, S3_ROCKS_FOLDER=FOLDER,
+               USERNAME=USER, PASSWORD=PASSWORD,
+               JOURNAL_DIR=os.path.join(work_dir, 'journal'),
+               JOURNAL_RETRY_DELAY='0.1', JOURNAL_MAX_RETRY_DELAY='1',
+               UPLOAD_SLOTS_DIR=os.path.join(work_dir, 'slots'),
+               UPLOADS_PER_WORKER=str(args.uploads_per_worker),
+               UPLOAD_QUEUE_SIZE=str(args.queue_size),
+               GUNICORN_THREADS=str(args.uploads_per_worker + args.queue_size + 16))
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', 'app:app', '--workers', str(workers),
+         '--bind', f'127.0.0.1:{port}', '--log-level', 'warning'],
+        cwd=ROOT, env=env)
+
+    stats = Run(args, workers)
+    try:
+        wait_for_port(port)
+        url = f'http://127.0.0.1:{port}'
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency)
+        session.mount('http://', adapter)
+
+        started = time.monotonic()
+        with ThreadPoolExecutor(args.concurrency) as pool:
+            for i in range(args.uploads):
+                pool.submit(stats.upload, session, url, i)
+                for j in range(args.gets_per_upload):
+                    pool.submit(stats.download, session, url, i * args.gets_per_upload + j)
+        elapsed = time.monotonic() - started
+
+        # Uploads answered with 202 are published by the journal replay
+        deadline = time.monotonic() + args.drain_timeout
+        while True:
+            manifest = client.get_object(Bucket=BUCKET, Key=f'{FOLDER}manifest')['Body'].read()
+            repository = manifest_repository(manifest.decode('utf-8'))
+            lost = {(package, version) for package, version in stats.accepted
+                    if version not in repository.get(package, {})}
+            if not lost or time.monotonic() > deadline:
+                break
+            time.sleep(0.5)
+    finally:
+        server.terminate()
+        server.wait()
+        s3.shutdown()
+
+    requests_count = len(stats.put_latencies) + len(stats.get_latencies)
+    return {
+        'workers': workers,
+        'rps': requests_count / elapsed,
+        'put_p50': percentile(stats.put_latencies, 50),
+        'put_p99': percentile(stats.put_latencies, 99),
+        'get_p50': percentile(stats.get_latencies, 50),
+        'get_p99': percentile(stats.get_latencies, 99),
+        'accepted': len(stats.accepted),
+        'lost': sorted(f'{package}-{version}' for package, version in lost),
+        'statuses': stats.statuses,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--uploads', type=int, default=1000)
+    parser.add_argument('--versions', type=int, default=4,
+                        help='versions uploaded per package')
+    parser.add_argument('--gets-per-upload', type=int, default=2)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help='seconds added to every S3 request')
+    parser.add_argument('--jitter', type=float, default=0.01)
+    parser.add_argument('--drain-timeout', type=float, default=60,
+                        help='seconds to wait for journaled uploads')
+    parser.add_argument('--uploads-per-worker', type=int, default=8)
+    parser.add_argument('--queue-size', type=int, default=64)
+    parser.add_argument('--attempts', type=int, default=20,
+                        help='attempts of an upload rejected with 429')
+    parser.add_argument('--max-retry-delay', type=float, default=1)
+    args = parser.parse_args()
+
+    os.chdir(ROOT)
+    print(f'{"workers":>7} {"req/s":>8} {"put p50":>8} {"put p99":>8} '
+          f'{"get p50":>8} {"get p99":>8} {"accepted":>8} {"lost":>5}  statuses')
+    failed = False
+    for workers in args.workers:
+        r = run(args, workers)
+        print(f'{r["workers"]:>7} {r["rps"]:>8.1f} {r["put_p50"] * 1000:>6.0f}ms '
+              f'{r["put_p99"] * 1000:>6.0f}ms {r["get_p50"] * 1000:>6.0f}ms '
+              f'{r["get_p99"] * 1000:>6.0f}ms {r["accepted"]:>8} {len(r["lost"]):>5}  '
+              f'{r["statuses"]}', flush=True)
+        if r['lost']:
+            failed = True
+            print(f'lost updates: {", ".join(r["lost"][:20])}', file=sys.stderr)
+        if r['accepted'] < args.uploads:
+            failed = True
+            print(f'only {r["accepted"]} of {args.uploads} uploads were accepted', file=sys.stderr)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+from app import (InvalidUsage, add_to_dependency_index, best_version, match_constraints,  # noqa
+                 parse_dependency, parse_rock_file_name, resolve_dependencies)
+
+
+def test_parse_rock_file_name():
+    assert parse_rock_file_name('fizz-buzz-scm-1.rockspec') == ('fizz-buzz', 'scm-1')
+    assert parse_rock_file_name('cartridge-2.7.0-1.all.rock') == ('cartridge', '2.7.0-1')
+    assert parse_rock_file_name('cartridge-2.7.0-1.src.rock') == ('cartridge', '2.7.0-1')
+    assert parse_rock_file_name('foo.rockspec') == (None, None)
+
+
+def test_match_constraints():
+    assert match_constraints('3.1.0-1', parse_dependency('checks == 3.1.0-1')[1])
+    assert match_constraints('3.1-2', parse_dependency('checks == 3.1')[1])
+    assert not match_constraints('3.1.0-2', parse_dependency('checks == 3.1.0-1')[1])
+    assert match_constraints('3.1.5-1', parse_dependency('checks ~> 3.1')[1])
+    assert not match_constraints('3.2.0-1', parse_dependency('checks ~> 3.1')[1])
+    assert match_constraints('2.0-1', parse_dependency('checks >= 1.0, < 3')[1])
+    assert not match_constraints('3.0-1', parse_dependency('checks >= 1.0, < 3')[1])
+    assert match_constraints('1.10-1', parse_dependency('checks > 1.9')[1])
+    assert match_constraints('scm-1', parse_dependency('checks > 99')[1])
+    assert match_constraints('1.0rc1-1', parse_dependency('checks < 1.0')[1])
+    assert match_constraints('1.0-1', parse_dependency('checks')[1])
+
+
+def test_parse_dependency():
+    # Commas between constraints are optional in LuaRocks
+    assert parse_dependency('bar >= 1 < 2') == parse_dependency('bar >= 1, < 2') == \
+        ('bar', [('>=', ([1], None)), ('<', ([2], None))])
+    assert parse_dependency('Lua>=5.1') == ('lua', [('>=', ([5, 1], None))])
+    assert parse_dependency('ns/name ~> 1.0') == ('ns/name', [('~>', ([1, 0], None))])
+    assert parse_dependency('checks 3.1.0-1') == ('checks', [('==', ([3, 1, 0], 1))])
+    for dependency in ['', '>= 1', 'bar => 1', 'bar >= 1, <', 'a/b/c']:
+        with pytest.raises(InvalidUsage):
+            parse_dependency(dependency)
+
+
+def test_best_version():
+    versions = ['1.0-1', '1.10-1', '1.9-1', 'scm-1']
+    assert best_version(versions) == '1.10-1'
+    assert best_version(versions, parse_dependency('x < 1.10')[1]) == '1.9-1'
+    assert best_version(versions, parse_dependency('x > 2')[1]) == 'scm-1'
+    assert best_version(versions, parse_dependency('x == 2')[1]) is None
+
+
+def test_dependency_index():
+    index = {}
+    add_to_dependency_index(index, 'a', '1.0-1', ['b >= 1', 'c'])
+    add_to_dependency_index(index, 'd', '1.0-1', ['b'])
+    assert index['reverse'] == {'b': {'a': ['1.0-1'], 'd': ['1.0-1']},
+                                'c': {'a': ['1.0-1']}}
+
+    # Re-uploads (scm rocks) replace the previous dependency list
+    add_to_dependency_index(index, 'a', '1.0-1', ['b'])
+    assert index['forward']['a'] == {'1.0-1': ['b']}
+    assert index['reverse'] == {'b': {'a': ['1.0-1'], 'd': ['1.0-1']}}
+
+
+def test_resolve_dependencies():
+    repository = {
+        'a': {'1.0-1': ['rockspec']},
+        'b': {'1.0-1': ['rockspec'], '2.0-1': ['rockspec']},
+        'c': {'1.0-1': ['all']},
+    }
+    forward = {
+        'a': {'1.0-1': ['lua >= 5.1', 'b', 'c']},
+        'b': {'2.0-1': ['c == 2.0']},
+    }
+    result = resolve_dependencies(repository, forward, 'a', '1.0-1')
+    assert result['dependencies'] == {'b': '2.0-1', 'c': '1.0-1'}
+    assert result['conflicts'] == [{'required_by': 'b 2.0-1',
+                                    'dependency': 'c == 2.0', 'resolved': '1.0-1'}]
+    assert result['unindexed'] == ['c 1.0-1']
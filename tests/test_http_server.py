@@ -1,3 +1,4 @@
+import hashlib
 import json
 import logging
 import os
@@ -6,7 +7,7 @@ import socket
 import string
 import sys
 import time
-from datetime import datetime
+from datetime import datetime, timezone
 from io import StringIO, BytesIO
 from textwrap import dedent
 from threading import Thread
@@ -31,6 +32,10 @@ def random_string(length=10):
 USER = random_string()
 PASSWORD = random_string()
 SERVER_MOCK = 'http://0.0.0.0:5000'
+# Files published along with the manifest after the first fizz-buzz upload
+FIZZ_BUZZ_INDEXES = ['checksums/fizz-buzz.json', 'shards/fizz-buzz', 'dependencies/fizz-buzz.json',
+                     'packages/fizz-buzz.json', 'packages/fizz-buzz.html', 'checksums.json',
+                     'manifest.current', 'dependencies.json', 'index.json', 'index.html']
 
 
 @pytest.fixture
@@ -38,6 +43,12 @@ def app(monkeypatch):
     import app
     S3Mock.instance = None
     monkeypatch.setattr(app.boto3, 'client', S3Mock)
+    monkeypatch.setattr(app, '_s3_client', None)
+    monkeypatch.setattr(app, 'object_cache', {})
+    monkeypatch.setattr(app, 'manifest_pointer_cache', {})
+    monkeypatch.setattr(app, 'snapshot_cache', {})
+    monkeypatch.setattr(app, 'shards_migrated', app.threading.Event())
+    monkeypatch.setattr(app, 'manifest_compiler', app.ManifestCompiler(delay=0))
     monkeypatch.setattr(app, 'USER', USER)
     monkeypatch.setattr(app, 'PASSWORD', PASSWORD)
     monkeypatch.setattr(app, 'patch_manifest_func', patch_manifest_func_mock)
@@ -68,6 +79,14 @@ def app(monkeypatch):
         finally:
             s.close()
 
+
+def published_files():
+    # Structured audit records, manifest snapshots and compilation
+    # state are checked separately
+    return [key for key in S3Mock.instance.files
+            if not key.startswith(('audit/', 'manifests/', 'compiled/'))]
+
+
 def get(rock):
     return requests.get(SERVER_MOCK + '/' + rock,
                         auth=HTTPBasicAuth(USER, PASSWORD),
@@ -129,7 +148,8 @@ def test_put(app):
 
     assert response.status_code == 201
     assert answer.get('message') == message
-    assert list(S3Mock.instance.files.keys()) == ['manifest', 'fizz-buzz-scm-1.rockspec', audit_file_name]
+    assert published_files() == ['manifest', 'fizz-buzz-scm-1.rockspec', audit_file_name] + \
+        FIZZ_BUZZ_INDEXES
     assert S3Mock.instance.files[rock_name].decode('utf-8') == rockspec
     assert S3Mock.instance.files['manifest'].decode('utf-8') == dedent("""\
             commands = {}
@@ -171,7 +191,8 @@ def test_put(app):
     answer = json.loads(response.content)
     assert response.status_code == 400
     assert answer.get('message') == 'rockspec name does not match package or version'
-    assert list(S3Mock.instance.files.keys()) == ['manifest', 'fizz-buzz-scm-1.rockspec', audit_file_name]
+    assert published_files() == ['manifest', 'fizz-buzz-scm-1.rockspec', audit_file_name] + \
+        FIZZ_BUZZ_INDEXES
     audit_log_list = S3Mock.instance.files[audit_file_name].decode('utf-8').strip().split('\n')
     assert len(audit_log_list) == 5
 
@@ -185,8 +206,8 @@ def test_put(app):
     md5hash = md5(BytesIO(rock_binary))
     assert response.status_code == 201
     assert answer.get('message') == message
-    assert list(S3Mock.instance.files.keys()) == ['manifest',
-        'fizz-buzz-scm-1.rockspec', audit_file_name, rock_name]
+    assert published_files() == ['manifest',
+        'fizz-buzz-scm-1.rockspec', audit_file_name] + FIZZ_BUZZ_INDEXES + [rock_name]
     assert len(audit_log_list) == 7
     assert md5hash in audit_log_entry
     assert f'| put {rock_name} - {message} | ' \
@@ -204,8 +225,8 @@ def test_put(app):
     answer = json.loads(response.content)
     assert response.status_code == 400
     assert answer.get('message') == 'package file was not found in request data'
-    assert list(S3Mock.instance.files.keys()) == ['manifest',
-        'fizz-buzz-scm-1.rockspec', audit_file_name, 'fizz-buzz-1.0.1-1.all.rock']
+    assert published_files() == ['manifest',
+        'fizz-buzz-scm-1.rockspec', audit_file_name] + FIZZ_BUZZ_INDEXES + ['fizz-buzz-1.0.1-1.all.rock']
     audit_log_list = S3Mock.instance.files[audit_file_name].decode('utf-8').strip().split('\n')
     assert len(audit_log_list) == 9
 
@@ -241,10 +262,980 @@ def test_brake_manifest(app):
     assert answer.get('message') == 'Some unexpected error'
 
     audit_file_name = f'{datetime.today().strftime("%y-%m")}.log'
-    assert list(sorted(S3Mock.instance.files.keys())) == \
-           list(sorted(['manifest', 'fizz-buzz-scm-1.rockspec', audit_file_name]))
+    assert sorted(published_files()) == \
+           list(sorted(['manifest', 'fizz-buzz-scm-1.rockspec', audit_file_name] + FIZZ_BUZZ_INDEXES))
 
     audit_log_list = S3Mock.instance.files[audit_file_name].decode('utf-8').strip().split('\n')
     audit_log_entry = audit_log_list[2]
     assert len(audit_log_list) == 3  # rock + manifest + error
     assert 'manifest update error: Some unexpected error' in audit_log_entry
+
+
+def test_resolve(app):
+    put(dedent("""\
+        package = 'checks'
+        version = '3.1.0-1'
+        dependencies = {'lua >= 5.1'}
+    """), 'checks-3.1.0-1.rockspec')
+    put(dedent("""\
+        package = 'checks'
+        version = '3.2.0-1'
+        dependencies = {'lua >= 5.1'}
+    """), 'checks-3.2.0-1.rockspec')
+    put(dedent("""\
+        package = 'errors'
+        version = '2.2.1-1'
+        dependencies = {'lua >= 5.1', 'checks ~> 3.1'}
+    """), 'errors-2.2.1-1.rockspec')
+    put(dedent("""\
+        package = 'cartridge'
+        version = '2.7.0-1'
+        dependencies = {'lua >= 5.1', 'checks == 3.1.0-1', 'errors >= 2.1', 'vshard == 0.1.19-1'}
+    """), 'cartridge-2.7.0-1.rockspec')
+
+    index = json.loads(S3Mock.instance.files['dependencies.json'])
+    assert index['forward']['errors'] == {'2.2.1-1': ['lua >= 5.1', 'checks ~> 3.1']}
+    assert index['reverse']['checks'] == {'cartridge': ['2.7.0-1'], 'errors': ['2.2.1-1']}
+
+    response = requests.get(SERVER_MOCK + '/api/resolve',
+                            params={'package': 'errors', 'version': '2.2.1-1'})
+    assert response.status_code == 200
+    assert response.json()['dependencies'] == {'checks': '3.1.0-1'}
+
+    response = requests.get(SERVER_MOCK + '/api/resolve', params={'package': 'cartridge'})
+    answer = response.json()
+    assert response.status_code == 200
+    assert answer['version'] == '2.7.0-1'
+    assert answer['dependencies'] == {'checks': '3.1.0-1', 'errors': '2.2.1-1'}
+    assert answer['missing'] == [{'required_by': 'cartridge 2.7.0-1',
+                                  'dependency': 'vshard == 0.1.19-1'}]
+    assert answer['conflicts'] == []
+
+    response = requests.get(SERVER_MOCK + '/api/resolve', params={'package': 'vshard'})
+    assert response.status_code == 404
+
+
+def test_upload_admission(app, monkeypatch):
+    import app as rocks_app
+    gate = rocks_app.UploadGate(per_worker=1, queue_size=0, retry_after=7)
+    monkeypatch.setattr(rocks_app, 'upload_gate', gate)
+
+    rockspec = """\
+        package = 'fizz-buzz'
+        version = 'scm-1'
+    """
+    with gate.admit():
+        response = put(rockspec, 'fizz-buzz-scm-1.rockspec')
+        assert response.status_code == 429
+        assert response.headers.get('Retry-After') == '7'
+
+        # Downloads don't go through the upload lane
+        assert get('manifest').status_code == 302
+
+    response = put(rockspec, 'fizz-buzz-scm-1.rockspec')
+    assert response.status_code == 201
+
+
+def test_upload_gate_node_slots(tmp_path):
+    import app as rocks_app
+    # Two gates sharing a slots directory behave like two worker processes
+    first = rocks_app.UploadGate(per_worker=2, per_node=1, queue_size=1,
+                                 timeout=0.1, slots_dir=str(tmp_path))
+    second = rocks_app.UploadGate(per_worker=2, per_node=1, queue_size=1,
+                                  timeout=0.1, slots_dir=str(tmp_path))
+    with first.admit():
+        with pytest.raises(rocks_app.InvalidUsage) as error:
+            with second.admit():
+                pass
+        assert error.value.status_code == 429
+    assert first.pending == 0 and second.pending == 0
+
+    with second.admit():
+        pass
+
+
+def test_download_lane(monkeypatch):
+    import app as rocks_app
+    monkeypatch.setattr(rocks_app, 'upload_gate', rocks_app.UploadGate(per_worker=2, queue_size=6))
+    rocks_app.check_download_lane(16)
+    with pytest.raises(RuntimeError):
+        rocks_app.check_download_lane(8)
+
+    monkeypatch.setattr(rocks_app, 'upload_gate', rocks_app.UploadGate(per_worker=0))
+    with pytest.raises(RuntimeError):
+        rocks_app.check_download_lane(16)
+
+
+def test_journal_replay(app, monkeypatch, tmp_path):
+    import app as rocks_app
+    journal = rocks_app.Journal(str(tmp_path))
+    started = []
+    monkeypatch.setattr(rocks_app, 'journal', journal)
+    monkeypatch.setattr(journal, 'start', lambda: started.append(True))
+
+    rockspec = """\
+        package = 'fizz-buzz'
+        version = 'scm-1'
+    """
+    rock_name = 'fizz-buzz-scm-1.rockspec'
+    upload_fileobj = S3Mock.upload_fileobj
+
+    def failing_upload_fileobj(self, Data, Bucket, Key):
+        if Key == rock_name:
+            raise RuntimeError('S3 is unavailable')
+        return upload_fileobj(self, Data, Bucket, Key)
+
+    monkeypatch.setattr(S3Mock, 'upload_fileobj', failing_upload_fileobj)
+    response = put(rockspec, rock_name)
+    assert response.status_code == 202
+    assert started == [True]
+    assert rock_name not in S3Mock.instance.files
+    assert 'fizz-buzz' not in S3Mock.instance.files['manifest'].decode('utf-8')
+    assert len(journal.entries()) == 1
+
+    # Storage is still down, the entry is kept
+    assert journal.replay(rocks_app.S3View().commit_journal_entry) is False
+    assert len(journal.entries()) == 1
+
+    monkeypatch.setattr(S3Mock, 'upload_fileobj', upload_fileobj)
+    assert journal.replay(rocks_app.S3View().commit_journal_entry) is True
+    assert journal.entries() == []
+    assert S3Mock.instance.files[rock_name].decode('utf-8') == rockspec
+    assert '["fizz-buzz"]' in S3Mock.instance.files['manifest'].decode('utf-8')
+
+
+def test_journal_storage_outage(app, monkeypatch, tmp_path):
+    import app as rocks_app
+    journal = rocks_app.Journal(str(tmp_path))
+    monkeypatch.setattr(rocks_app, 'journal', journal)
+    monkeypatch.setattr(journal, 'start', lambda: None)
+    get_object = S3Mock.get_object
+
+    def failing_get_object(self, Bucket, Key, **kwargs):
+        raise RuntimeError('S3 is unavailable')
+
+    # Even the shard can't be read, the upload is checked on replay
+    monkeypatch.setattr(S3Mock, 'get_object', failing_get_object)
+    response = put("package = 'foo'\nversion = '1.0-1'\n", 'foo-1.0-1.rockspec')
+    assert response.status_code == 202
+    assert len(journal.entries()) == 1
+
+    monkeypatch.setattr(S3Mock, 'get_object', get_object)
+    assert journal.replay(rocks_app.S3View().commit_journal_entry) is True
+    assert 'foo' in rocks_app.manifest_repository(S3Mock.instance.files['manifest'].decode('utf-8'))
+
+    # A journaled duplicate never replaces the published file
+    monkeypatch.setattr(S3Mock, 'get_object', failing_get_object)
+    response = put("package = 'foo'\nversion = '1.0-1'\n-- changed\n", 'foo-1.0-1.rockspec')
+    assert response.status_code == 202
+    monkeypatch.setattr(S3Mock, 'get_object', get_object)
+    assert journal.replay(rocks_app.S3View().commit_journal_entry) is True
+    assert journal.entries() == []
+    assert S3Mock.instance.files['foo-1.0-1.rockspec'] == b"package = 'foo'\nversion = '1.0-1'\n"
+
+
+def test_journal_quarantine(tmp_path):
+    import app as rocks_app
+    journal = rocks_app.Journal(str(tmp_path), max_attempts=2)
+    for file_name in ['broken-1.0-1.rockspec', 'rejected-1.0-1.rockspec',
+                      'missing-1.0-1.rockspec', 'foo-1.0-1.rockspec']:
+        with journal.record(file_name, b'', True, ''):
+            pass
+    committed = []
+    manifest_found = False
+
+    def commit(meta, package):
+        if meta['file_name'].startswith('broken'):
+            raise RuntimeError('always fails')
+        if meta['file_name'].startswith('rejected'):
+            raise rocks_app.RockRejected('the rock already exists')
+        if meta['file_name'].startswith('missing') and not manifest_found:
+            raise rocks_app.InvalidUsage('manifest file was not found in the bucket')
+        committed.append(meta['file_name'])
+        return True
+
+    assert journal.replay(commit) is False
+    assert len(journal.entries()) == 4
+    # Failing entries are quarantined and don't block the entries after
+    # them, rejected ones right away
+    assert journal.replay(commit) is False
+    assert len(os.listdir(journal.quarantine_path)) == 2
+    # Storage state errors are retried
+    assert len(journal.entries()) == 2
+    manifest_found = True
+    assert journal.replay(commit) is True
+    assert journal.entries() == []
+    assert committed == ['missing-1.0-1.rockspec', 'foo-1.0-1.rockspec']
+
+
+def test_journal_finishes_committed_upload(app, monkeypatch, tmp_path):
+    import app as rocks_app
+    journal = rocks_app.Journal(str(tmp_path))
+    monkeypatch.setattr(rocks_app, 'journal', journal)
+    monkeypatch.setattr(journal, 'start', lambda: None)
+    monkeypatch.setattr(rocks_app, 'manifest_compiler', rocks_app.ManifestCompiler(delay=60))
+
+    # The shard is stored, but the worker fails before the rest of the upload
+    def failing_update_dependency_index(self, file_name, package):
+        raise RuntimeError('S3 is unavailable')
+
+    update_dependency_index = rocks_app.S3View.update_dependency_index
+    monkeypatch.setattr(rocks_app.S3View, 'update_dependency_index',
+                        failing_update_dependency_index)
+    rockspec = "package = 'foo'\nversion = '1.0-1'\ndependencies = {'bar'}\n"
+    assert put(rockspec, 'foo-1.0-1.rockspec').status_code == 202
+    assert 'shards/foo' in S3Mock.instance.files
+    assert not rocks_app.manifest_compiler.stale.is_set()
+
+    monkeypatch.setattr(rocks_app.S3View, 'update_dependency_index', update_dependency_index)
+    assert journal.replay(rocks_app.S3View().commit_journal_entry) is True
+    assert journal.entries() == []
+    assert not os.path.exists(journal.quarantine_path)
+    assert json.loads(S3Mock.instance.files['dependencies/foo.json']) == {'1.0-1': ['bar']}
+    assert 'packages/foo.json' in S3Mock.instance.files
+    assert rocks_app.manifest_compiler.stale.is_set()
+
+
+def test_concurrent_manifest_update(app, monkeypatch):
+    import app as rocks_app
+
+    # Another worker commits its rock between our manifest read and write
+    def racing_patch_manifest_func(manifest, filename, *args):
+        if filename == 'foo-scm-1.rockspec':
+            monkeypatch.setattr(rocks_app, 'patch_manifest_func', patch_manifest_func_mock)
+            _, concurrent = patch_manifest_func_mock(
+                S3Mock.instance.files['manifest'].decode('utf-8'), 'bar-scm-1.all.rock')
+            S3Mock.instance.files['manifest'] = concurrent.encode('utf-8')
+        return patch_manifest_func_mock(manifest, filename, *args)
+
+    monkeypatch.setattr(rocks_app, 'patch_manifest_func', racing_patch_manifest_func)
+    response = put("package = 'foo'\nversion = 'scm-1'\n", 'foo-scm-1.rockspec')
+    assert response.status_code == 201
+
+    repository = rocks_app.manifest_repository(S3Mock.instance.files['manifest'].decode('utf-8'))
+    assert repository == {'foo': {'scm-1': ['rockspec']}, 'bar': {'scm-1': ['all']}}
+
+
+def test_checksums(app):
+    rockspec = """\
+        package = 'fizz-buzz'
+        version = 'scm-1'
+    """
+    put(rockspec, 'fizz-buzz-scm-1.rockspec')
+    rock_binary = b'fizz-buzz-1.0.1-1.zip'
+    put(rock_binary, 'fizz-buzz-1.0.1-1.all.rock', binary=True)
+
+    expected = {
+        'fizz-buzz-scm-1.rockspec': {
+            'md5': md5(BytesIO(rockspec.encode('utf-8'))),
+            'sha256': hashlib.sha256(rockspec.encode('utf-8')).hexdigest(),
+            'size': len(rockspec),
+        },
+        'fizz-buzz-1.0.1-1.all.rock': {
+            'md5': md5(BytesIO(rock_binary)),
+            'sha256': hashlib.sha256(rock_binary).hexdigest(),
+            'size': len(rock_binary),
+        },
+    }
+    assert json.loads(S3Mock.instance.files['checksums.json']) == expected
+
+    response = get('checksums.json')
+    assert response.headers.get('Location') == 'https://hb.bizmrd.ru/tarantool/checksums.json'
+
+    response = requests.get(SERVER_MOCK + '/api/checksums',
+                            params={'file': 'fizz-buzz-1.0.1-1.all.rock'})
+    assert response.status_code == 200
+    assert response.json() == expected['fizz-buzz-1.0.1-1.all.rock']
+
+    response = requests.get(SERVER_MOCK + '/api/checksums')
+    assert response.json() == expected
+
+    response = requests.get(SERVER_MOCK + '/api/checksums', params={'file': 'foo-scm-1.rockspec'})
+    assert response.status_code == 404
+
+
+def test_index_pages(app):
+    S3Mock().files['manifest'] = dedent("""\
+        commands = {}
+        modules = {}
+        repository = {
+            ["fizz-buzz"] = {
+                ["0.9-1"] = {
+                    {
+                        arch = "all"
+                    }
+                }
+            }
+        }
+    """).encode('utf-8')
+
+    rockspec = """\
+        package = 'fizz-buzz'
+        version = '1.0.1-1'
+    """
+    put(rockspec, 'fizz-buzz-1.0.1-1.rockspec')
+    put(b'fizz-buzz-1.0.1-1.zip', 'fizz-buzz-1.0.1-1.all.rock', binary=True)
+    put("package = 'foo'\nversion = 'scm-1'\n", 'foo-scm-1.rockspec')
+
+    page = json.loads(S3Mock.instance.files['packages/fizz-buzz.json'])
+    assert page['package'] == 'fizz-buzz'
+    assert sorted(page['versions']) == ['0.9-1', '1.0.1-1']
+    assert page['versions']['0.9-1'] == {'all': None}
+    rockspec_entry = page['versions']['1.0.1-1']['rockspec']
+    assert rockspec_entry['file'] == 'fizz-buzz-1.0.1-1.rockspec'
+    assert rockspec_entry['sha256'] == hashlib.sha256(rockspec.encode('utf-8')).hexdigest()
+    assert rockspec_entry['uploaded']
+    assert page['versions']['1.0.1-1']['all']['file'] == 'fizz-buzz-1.0.1-1.all.rock'
+
+    index = json.loads(S3Mock.instance.files['index.json'])
+    assert sorted(index['packages']) == ['fizz-buzz', 'foo']
+    assert index['packages']['fizz-buzz']['latest'] == '1.0.1-1'
+    assert index['packages']['fizz-buzz']['versions'] == 2
+    assert index['packages']['foo']['latest'] == 'scm-1'
+
+    index_html = S3Mock.instance.files['index.html'].decode('utf-8')
+    assert '<a href="packages/fizz-buzz.html">fizz-buzz</a>' in index_html
+    assert '<a href="packages/foo.html">foo</a>' in index_html
+
+    package_html = S3Mock.instance.files['packages/fizz-buzz.html'].decode('utf-8')
+    assert '<a href="../fizz-buzz-1.0.1-1.all.rock">' in package_html
+    assert '<a href="../fizz-buzz-0.9-1.all.rock">' in package_html
+    assert rockspec_entry['sha256'] in package_html
+    assert package_html.index('1.0.1-1') < package_html.index('0.9-1')
+
+
+def audit(**params):
+    return requests.get(SERVER_MOCK + '/api/audit', params=params,
+                        auth=HTTPBasicAuth(USER, PASSWORD))
+
+
+def test_audit_api(app, monkeypatch):
+    import app as rocks_app
+    monkeypatch.setattr(rocks_app, 'S3_AUDIT_FOLDER', 'logs/')
+
+    put("package = 'foo'\nversion = 'scm-1'\n", 'foo-scm-1.rockspec')
+    put("package = 'bar'\nversion = 'scm-1'\n", 'bar-scm-1.rockspec')
+    put("package = 'foo'\nversion = '1.0-1'\n", 'foo-2.0-1.rockspec')
+    put(b'zip', 'foo-1.0-1.x86.rock', binary=True)
+
+    # Every record is a separate object of the month, indexed by package with markers
+    month = datetime.utcnow().strftime('%y-%m')
+    folders = [key.rsplit('/', 1)[0] for key in S3Mock.instance.files
+               if key.startswith(f'logs/audit/{month}/')]
+    assert sorted(folders) == [f'logs/audit/{month}'] * 6 + \
+        [f'logs/audit/{month}/packages/bar'] * 2 + [f'logs/audit/{month}/packages/foo'] * 4
+    assert not any(key.startswith('audit/') for key in S3Mock.instance.files)
+
+    response = requests.get(SERVER_MOCK + '/api/audit')
+    assert response.status_code == 401
+
+    records = audit(package='foo').json()['records']
+    assert [(r['action'], r['file'], r['outcome']) for r in records] == [
+        ('upload', 'foo-scm-1.rockspec', 'success'),
+        ('update', 'shards/foo', 'success'),
+        ('put', 'foo-2.0-1.rockspec', 'rejected'),
+        ('put', 'foo-1.0-1.x86.rock', 'rejected'),
+    ]
+    assert records[0]['user'] == USER
+    assert records[0]['remote_addr'] == '127.0.0.1'
+    assert records[0]['md5'] == md5(BytesIO(b"package = 'foo'\nversion = 'scm-1'\n"))
+
+    records = audit(outcome='rejected').json()['records']
+    assert [r['file'] for r in records] == ['foo-2.0-1.rockspec', 'foo-1.0-1.x86.rock']
+
+    all_ids = [r['id'] for r in audit().json()['records']]
+    assert len(all_ids) == 6  # 2 rocks + 2 manifest shard updates + 2 rejections
+    answer = audit(limit=4).json()
+    assert [r['id'] for r in answer['records']] == all_ids[:4]
+    answer = audit(limit=4, page=answer['next']).json()
+    assert [r['id'] for r in answer['records']] == all_ids[4:]
+    assert answer['next'] is None
+
+    assert audit(until='2000-01-01').json()['records'] == []
+
+    # Listings start at the page cursor instead of the beginning of the month
+    listings = []
+    list_objects_v2 = S3Mock.list_objects_v2
+
+    def recording_list_objects_v2(self, **kwargs):
+        response = list_objects_v2(self, **kwargs)
+        listings.append((kwargs.get('StartAfter'), [obj['Key'] for obj in response['Contents']]))
+        return response
+
+    monkeypatch.setattr(S3Mock, 'list_objects_v2', recording_list_objects_v2)
+    answer = audit(limit=4).json()
+    listings.clear()
+    assert [r['id'] for r in audit(limit=4, page=answer['next']).json()['records']] == \
+        all_ids[4:]
+    assert listings == [(f'logs/audit/{month}/{all_ids[3]}',
+                         [f'logs/audit/{month}/{record_id}.json' for record_id in all_ids[3:]])]
+
+
+def test_audit_pagination_across_months(app):
+    import app as rocks_app
+    view = rocks_app.S3View()
+    for month, count in [(9, 3), (10, 5)]:
+        for day in range(1, count + 1):
+            timestamp = datetime(2026, month, day, tzinfo=timezone.utc)
+            view.store_audit_record({
+                'id': rocks_app.audit_record_id(timestamp), 'timestamp': timestamp.isoformat(),
+                'action': 'put', 'file': 'foo-scm-1.rockspec', 'outcome': 'success'})
+
+    pages = []
+    answer = {'next': ''}
+    while answer['next'] is not None:
+        answer = audit(since='2026-09-01', until='2026-10-31', limit=3,
+                       page=answer['next']).json()
+        pages.append([(r['month'], r['timestamp'][8:10]) for r in answer['records']])
+    assert pages == [
+        [('26-09', '01'), ('26-09', '02'), ('26-09', '03')],
+        [('26-10', '01'), ('26-10', '02'), ('26-10', '03')],
+        [('26-10', '04'), ('26-10', '05')],
+    ]
+
+
+def test_audit_is_best_effort(app, monkeypatch):
+    import app as rocks_app
+
+    def failing_store_audit_record(self, record):
+        raise rocks_app.WriteConflict('audit record')
+
+    monkeypatch.setattr(rocks_app.S3View, 'store_audit_record', failing_store_audit_record)
+    put_object = S3Mock.put_object
+
+    def failing_log_put_object(self, Bucket, Key, Body, **kwargs):
+        if Key.endswith('.log'):
+            raise RuntimeError('S3 is unavailable')
+        return put_object(self, Bucket, Key, Body, **kwargs)
+
+    monkeypatch.setattr(S3Mock, 'put_object', failing_log_put_object)
+    response = put("package = 'foo'\nversion = 'scm-1'\n", 'foo-scm-1.rockspec')
+    assert response.status_code == 201
+    assert 'foo-scm-1.rockspec' in S3Mock.instance.files
+    assert 'foo' in rocks_app.manifest_repository(S3Mock.instance.files['manifest'].decode())
+
+
+def test_audit_log_concurrent_append(app, monkeypatch):
+    import app as rocks_app
+    log_name = f'{datetime.today().strftime("%y-%m")}.log'
+    read_object = rocks_app.S3View.read_object
+
+    # Another worker appends its line between our read and write
+    def racing_read_object(self, filename, folder=None):
+        result = read_object(self, filename, folder)
+        if filename == log_name and not racing_read_object.raced:
+            racing_read_object.raced = True
+            S3Mock.instance.files[log_name] = (result[0] or b'') + b'concurrent line\n'
+        return result
+
+    racing_read_object.raced = False
+    monkeypatch.setattr(rocks_app.S3View, 'read_object', racing_read_object)
+    rocks_app.S3View().audit_log('our line', action='put')
+    assert S3Mock().files[log_name].decode('utf-8').splitlines()[0] == 'concurrent line'
+    assert 'our line' in S3Mock.instance.files[log_name].decode('utf-8').splitlines()[1]
+
+
+def test_readiness(app, monkeypatch):
+    import app as rocks_app
+    monkeypatch.setattr(rocks_app, 'ready', rocks_app.threading.Event())
+
+    response = requests.get(SERVER_MOCK + '/healthz')
+    assert response.status_code == 200
+    assert response.json() == {'status': 'ok'}
+
+    manifest = S3Mock().files.pop('manifest')
+    response = requests.get(SERVER_MOCK + '/readyz')
+    assert response.status_code == 503
+    assert response.json() == {'status': 'starting'}
+
+    S3Mock.instance.files['manifest'] = manifest
+    response = requests.get(SERVER_MOCK + '/readyz')
+    assert response.status_code == 200
+    answer = response.json()
+    assert answer['status'] == 'ready'
+    assert set(answer['timings']) == {'lua', 's3_client', 'manifest'}
+
+    # The pointer and the current snapshot are loaded before the worker is ready
+    put("package = 'foo'\nversion = 'scm-1'\n", 'foo-scm-1.rockspec')
+    snapshot = rocks_app.snapshot_name(S3Mock.instance.files['manifest'])
+    monkeypatch.setattr(rocks_app, 'ready', rocks_app.threading.Event())
+    rocks_app.manifest_pointer_cache.clear()
+    rocks_app.snapshot_cache.clear()
+    snapshot_file = S3Mock.instance.files.pop(f'manifests/{snapshot}')
+    assert requests.get(SERVER_MOCK + '/readyz').status_code == 503
+
+    S3Mock.instance.files[f'manifests/{snapshot}'] = snapshot_file
+    assert requests.get(SERVER_MOCK + '/readyz').status_code == 200
+    assert rocks_app.manifest_pointer_cache['pointer'][1]['snapshot'] == snapshot
+    assert rocks_app.snapshot_cache == {snapshot: snapshot_file}
+
+
+def test_manifest_cache(app):
+    import app as rocks_app
+    put("package = 'foo'\nversion = 'scm-1'\n", 'foo-scm-1.rockspec')
+    # The manifest is revalidated, not downloaded again, while it's unchanged
+    manifest = S3Mock.instance.files['manifest']
+    assert rocks_app.object_cache['manifest'] == (manifest, S3Mock.etag(manifest))
+
+    rocks_app.object_cache['manifest'] = (b'stale', S3Mock.etag(manifest))
+    assert rocks_app.S3View().read_manifest()[0] == b'stale'
+
+    S3Mock.instance.files['manifest'] = manifest + b'\n'
+    assert rocks_app.S3View().read_manifest()[0] == manifest + b'\n'
+
+
+def test_rock_cache(app, monkeypatch, tmp_path):
+    import app as rocks_app
+    cache = rocks_app.RockCache(str(tmp_path), max_bytes=100)
+    monkeypatch.setattr(rocks_app, 'rock_cache', cache)
+
+    rockspec = "package = 'foo'\nversion = 'scm-1'\n"
+    put(rockspec, 'foo-scm-1.rockspec')
+    fetches = []
+    get_object = S3Mock.get_object
+
+    def counting_get_object(self, Bucket, Key, **kwargs):
+        fetches.append(Key)
+        return get_object(self, Bucket, Key, **kwargs)
+
+    monkeypatch.setattr(S3Mock, 'get_object', counting_get_object)
+
+    response = get('foo-scm-1.rockspec')
+    assert response.status_code == 200
+    assert response.text == rockspec
+    etag = response.headers['ETag']
+    assert etag == S3Mock.etag(rockspec.encode('utf-8'))
+
+    response = get('foo-scm-1.rockspec')
+    assert response.text == rockspec
+    assert fetches == ['foo-scm-1.rockspec']
+
+    response = requests.get(SERVER_MOCK + '/foo-scm-1.rockspec', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    response = requests.get(SERVER_MOCK + '/foo-scm-1.rockspec', headers={'Range': 'bytes=0-6'})
+    assert response.status_code == 206
+    assert response.text == 'package'
+
+    # Manifest is mutable and still served from S3
+    assert get('manifest').status_code == 302
+    assert get('bar-scm-1.rockspec').status_code == 404
+
+    # scm rocks are dropped from the cache when they are uploaded again
+    rockspec = "package = 'foo'\nversion = 'scm-1'\ndescription = 'updated'\n"
+    put(rockspec, 'foo-scm-1.rockspec')
+    assert get('foo-scm-1.rockspec').text == rockspec
+    assert fetches.count('foo-scm-1.rockspec') == 2
+
+    # Expired scm rocks are revalidated and downloaded again only if changed
+    monkeypatch.setattr(cache, 'scm_ttl', 0)
+    downloads = []
+
+    def downloading_get_object(self, Bucket, Key, **kwargs):
+        response = counting_get_object(self, Bucket, Key, **kwargs)
+        downloads.append(Key)
+        return response
+
+    monkeypatch.setattr(S3Mock, 'get_object', downloading_get_object)
+    assert get('foo-scm-1.rockspec').text == rockspec
+    assert fetches.count('foo-scm-1.rockspec') == 3
+    assert downloads == []
+    rockspec = "package = 'foo'\nversion = 'scm-1'\ndescription = 'changed'\n"
+    S3Mock.instance.files['foo-scm-1.rockspec'] = rockspec.encode('utf-8')
+    assert get('foo-scm-1.rockspec').text == rockspec
+    assert downloads == ['foo-scm-1.rockspec']
+    monkeypatch.setattr(cache, 'scm_ttl', 60)
+
+    # Least recently used files are evicted beyond the size budget
+    for name in ['a-1.0-1.all.rock', 'b-1.0-1.all.rock', 'c-1.0-1.all.rock']:
+        S3Mock.instance.files[name] = b'x' * 40
+        assert get(name).status_code == 200
+    cached = sorted(f for f in os.listdir(tmp_path) if not f.endswith(('.meta', '.lock')))
+    assert cached == ['b-1.0-1.all.rock', 'c-1.0-1.all.rock']
+    assert cache.total <= 100
+
+
+def test_rock_cache_single_flight(tmp_path):
+    import app as rocks_app
+    cache = rocks_app.RockCache(str(tmp_path), max_bytes=1024)
+    fetches = []
+
+    def slow_fetch(name, fileobj, etag=None):
+        fetches.append(name)
+        time.sleep(0.2)
+        fileobj.write(b'rock')
+        return '"etag"'
+
+    results = []
+    threads = [Thread(target=lambda: results.append(cache.get('a-1.0-1.all.rock', slow_fetch)))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert fetches == ['a-1.0-1.all.rock']
+    assert results == [(str(tmp_path / 'a-1.0-1.all.rock'), 'etag')] * 8
+
+
+def test_rock_cache_locks(tmp_path):
+    import app as rocks_app
+    cache = rocks_app.RockCache(str(tmp_path), max_bytes=1024)
+
+    # Misses of nonexistent files don't leave a lock file per name
+    for i in range(200):
+        assert cache.get(f'missing-{i}-1.0-1.all.rock', lambda name, fileobj, etag: None) is None
+    assert len(os.listdir(tmp_path)) <= rocks_app.RockCache.LOCK_STRIPES
+
+
+def test_rock_cache_concurrent_eviction(app, monkeypatch, tmp_path):
+    import app as rocks_app
+    cache = rocks_app.RockCache(str(tmp_path), max_bytes=1024)
+    monkeypatch.setattr(rocks_app, 'rock_cache', cache)
+    S3Mock().files['a-1.0-1.all.rock'] = b'rock'
+    assert get('a-1.0-1.all.rock').content == b'rock'
+
+    # Another worker evicts the file right after it was looked up
+    lookup = cache.lookup
+
+    def racing_lookup(name):
+        meta = lookup(name)
+        if meta is not None and not racing_lookup.evicted:
+            racing_lookup.evicted = True
+            cache.invalidate(name)
+        return meta
+
+    racing_lookup.evicted = False
+    monkeypatch.setattr(cache, 'lookup', racing_lookup)
+    response = get('a-1.0-1.all.rock')
+    assert response.status_code == 200
+    assert response.content == b'rock'
+
+    # ... or right before it's sent
+    send_file = rocks_app.send_file
+
+    def racing_send_file(path, **kwargs):
+        if not racing_send_file.evicted:
+            racing_send_file.evicted = True
+            cache.invalidate(os.path.basename(path))
+        return send_file(path, **kwargs)
+
+    racing_send_file.evicted = False
+    monkeypatch.setattr(rocks_app, 'send_file', racing_send_file)
+    response = get('a-1.0-1.all.rock')
+    assert response.status_code == 200
+    assert response.content == b'rock'
+
+
+def test_manifest_snapshots(app, monkeypatch):
+    import app as rocks_app
+    monkeypatch.setattr(rocks_app, 'MANIFEST_SNAPSHOTS', 2)
+
+    snapshots = []
+    for version in ['1.0-1', '2.0-1', '3.0-1']:
+        put(f"package = 'foo'\nversion = '{version}'\n", f'foo-{version}.rockspec')
+        snapshots.append(rocks_app.snapshot_name(S3Mock.instance.files['manifest']))
+
+    # The manifest is served from an immutable snapshot behind a short lived pointer
+    response = get('manifest')
+    assert response.status_code == 302
+    assert response.headers['Location'] == f'/manifests/{snapshots[-1]}'
+    assert response.headers['Cache-Control'] == 'public, max-age=60'
+
+    response = get(f'manifests/{snapshots[-1]}')
+    assert response.status_code == 200
+    assert response.content == S3Mock.instance.files['manifest']
+    assert response.headers['Cache-Control'] == 'public, max-age=31536000, immutable'
+    response = requests.get(f'{SERVER_MOCK}/manifests/{snapshots[-1]}',
+                            headers={'If-None-Match': response.headers['ETag']})
+    assert response.status_code == 304
+    assert get('manifests/manifest-unknown').status_code == 404
+
+    # Snapshots beyond MANIFEST_SNAPSHOTS are kept while redirects to them may be cached
+    def stored_snapshots():
+        return sorted(key for key in S3Mock.instance.files if key.startswith('manifests/'))
+
+    assert stored_snapshots() == sorted(f'manifests/{name}' for name in snapshots)
+    pointer = json.loads(S3Mock.instance.files['manifest.current'])
+    assert pointer['snapshot'] == snapshots[-1]
+    assert pointer['history'] == snapshots[::-1]
+    assert sorted(pointer['superseded']) == sorted(snapshots[:2])
+
+    # ... and only the last MANIFEST_SNAPSHOTS ones after that
+    pointer['superseded'] = {name: '2000-01-01T00:00:00+00:00' for name in pointer['superseded']}
+    S3Mock.instance.files['manifest.current'] = json.dumps(pointer).encode('utf-8')
+    put("package = 'foo'\nversion = '4.0-1'\n", 'foo-4.0-1.rockspec')
+    snapshots.append(rocks_app.snapshot_name(S3Mock.instance.files['manifest']))
+    assert stored_snapshots() == sorted(f'manifests/{name}' for name in snapshots[2:])
+    pointer = json.loads(S3Mock.instance.files['manifest.current'])
+    assert pointer['history'] == snapshots[:1:-1]
+    snapshots.pop(0)
+
+    result = rocks_app.app.test_cli_runner().invoke(rocks_app.rollback_manifest, [])
+    assert result.exit_code == 0, result.output
+    assert S3Mock.instance.files['manifest'] == S3Mock.instance.files[f'manifests/{snapshots[1]}']
+    pointer = json.loads(S3Mock.instance.files['manifest.current'])
+    assert pointer['snapshot'] == snapshots[1]
+    assert get('manifest').headers['Location'] == f'/manifests/{snapshots[1]}'
+    # Listings show only the versions of the restored manifest
+    page = json.loads(S3Mock.instance.files['packages/foo.json'])
+    assert sorted(page['versions']) == ['1.0-1', '2.0-1', '3.0-1']
+    assert page['versions']['1.0-1']['rockspec']['file'] == 'foo-1.0-1.rockspec'
+    assert '4.0-1' not in S3Mock.instance.files['packages/foo.html'].decode('utf-8')
+    assert json.loads(S3Mock.instance.files['index.json'])['packages']['foo']['latest'] == '3.0-1'
+
+    result = rocks_app.app.test_cli_runner().invoke(rocks_app.rollback_manifest, [snapshots[0]])
+    assert result.exit_code != 0
+    assert 'was not found' in result.output
+
+
+def test_manifest_shards(app, monkeypatch):
+    import app as rocks_app
+    monkeypatch.setattr(rocks_app, 'manifest_compiler', rocks_app.ManifestCompiler(delay=0.3))
+    compilations = []
+    compile_manifest = rocks_app.S3View.compile_manifest
+
+    def counting_compile_manifest(self):
+        compilations.append(True)
+        return compile_manifest(self)
+
+    monkeypatch.setattr(rocks_app.S3View, 'compile_manifest', counting_compile_manifest)
+
+    # Uploads only write the shard of their package
+    assert put("package = 'foo'\nversion = 'scm-1'\n", 'foo-scm-1.rockspec').status_code == 201
+    assert put("package = 'bar'\nversion = 'scm-1'\n", 'bar-scm-1.rockspec').status_code == 201
+    assert rocks_app.manifest_repository(S3Mock.instance.files['shards/foo'].decode('utf-8')) == \
+        {'foo': {'scm-1': ['rockspec']}}
+    assert rocks_app.manifest_repository(S3Mock.instance.files['manifest'].decode('utf-8')) == {}
+
+    # A burst of uploads is compiled once
+    time.sleep(0.6)
+    assert rocks_app.manifest_repository(S3Mock.instance.files['manifest'].decode('utf-8')) == \
+        {'foo': {'scm-1': ['rockspec']}, 'bar': {'scm-1': ['rockspec']}}
+    assert compilations == [True]
+
+    # Readers get the last compiled manifest without waiting for pending changes
+    put("package = 'foo'\nversion = '1.0-1'\n", 'foo-1.0-1.rockspec')
+    started = time.monotonic()
+    snapshot = get('manifest').headers['Location']
+    assert time.monotonic() - started < 0.2
+    assert '["1.0-1"]' not in get(snapshot.lstrip('/')).text
+    time.sleep(0.6)
+    assert compilations == [True, True]
+    rocks_app.manifest_pointer_cache.clear()
+    snapshot = get('manifest').headers['Location']
+    assert '["1.0-1"]' in get(snapshot.lstrip('/')).text
+
+
+def test_compilation_failures(app, monkeypatch):
+    import app as rocks_app
+    put("package = 'foo'\nversion = '1.0-1'\ndependencies = {'bar >= 1 < 2', 'baz ?? 1'}\n",
+        'foo-1.0-1.rockspec')
+    # A dependency that can't be parsed doesn't break the indexes
+    index = json.loads(S3Mock.instance.files['dependencies.json'])
+    assert index['forward']['foo'] == {'1.0-1': ['bar >= 1 < 2', 'baz ?? 1']}
+    assert index['reverse'] == {'bar': {'foo': ['1.0-1']}}
+    assert 'foo' in json.loads(S3Mock.instance.files['index.json'])['packages']
+
+    # A failing target doesn't keep the others from being compiled
+    def failing_compile_manifest(self):
+        raise RuntimeError('manifest is broken')
+
+    monkeypatch.setattr(rocks_app.S3View, 'compile_manifest', failing_compile_manifest)
+    put("package = 'bar'\nversion = '1.0-1'\n", 'bar-1.0-1.rockspec')
+    assert 'bar' in json.loads(S3Mock.instance.files['index.json'])['packages']
+    assert 'bar-1.0-1.rockspec' in json.loads(S3Mock.instance.files['checksums.json'])
+    with pytest.raises(RuntimeError, match='compilation of manifest failed'):
+        rocks_app.S3View().compile_indexes()
+
+
+def test_manifest_readers_share_compilation(monkeypatch):
+    import app as rocks_app
+    compiler = rocks_app.ManifestCompiler(delay=60)
+    compilations = []
+
+    def slow_compile_indexes(self):
+        compilations.append(True)
+        time.sleep(0.2)
+        # Uploads keep coming while the manifest is compiled
+        if len(compilations) == 1:
+            compiler.schedule()
+
+    monkeypatch.setattr(rocks_app.S3View, 'compile_indexes', slow_compile_indexes)
+    compiler.schedule()
+    readers = [Thread(target=compiler.compile_if_stale) for _ in range(8)]
+    for reader in readers:
+        reader.start()
+    for reader in readers:
+        reader.join()
+    # Readers waiting for a compilation don't compile changes made after they came
+    assert compilations == [True]
+
+    compiler.compile_if_stale()
+    assert compilations == [True, True]
+
+
+def test_migrate_shards(app, monkeypatch):
+    import app as rocks_app
+    S3Mock().files['manifest'] = dedent("""\
+        commands = {}
+        modules = {}
+        repository = {
+            bar = {
+                ["1.0-1"] = {
+                    {
+                        arch = "rockspec"
+                    }
+                }
+            },
+            foo = {
+                ["1.0-1"] = {
+                    {
+                        arch = "all"
+                    }
+                }
+            }
+        }
+    """).encode('utf-8')
+    # Shards stored by uploads are kept
+    put("package = 'bar'\nversion = '2.0-1'\n", 'bar-2.0-1.rockspec')
+    bar_shard = S3Mock.instance.files['shards/bar']
+
+    result = rocks_app.app.test_cli_runner().invoke(rocks_app.migrate_shards, ['--workers', '2'])
+    assert result.exit_code == 0, result.output
+    assert 'stored shards of 2 packages' in result.output
+    assert S3Mock.instance.files['shards/bar'] == bar_shard
+    assert rocks_app.manifest_repository(S3Mock.instance.files['shards/foo'].decode('utf-8')) == \
+        {'foo': {'1.0-1': ['all']}}
+
+    # New packages start with an empty shard without reading the manifest
+    reads = []
+    get_object = S3Mock.get_object
+
+    def counting_get_object(self, Bucket, Key, **kwargs):
+        reads.append(Key)
+        return get_object(self, Bucket, Key, **kwargs)
+
+    monkeypatch.setattr(S3Mock, 'get_object', counting_get_object)
+    monkeypatch.setattr(rocks_app, 'manifest_compiler', rocks_app.ManifestCompiler(delay=60))
+    assert put("package = 'baz'\nversion = '1.0-1'\n", 'baz-1.0-1.rockspec').status_code == 201
+    assert put("package = 'qux'\nversion = '1.0-1'\n", 'qux-1.0-1.rockspec').status_code == 201
+    assert 'manifest' not in reads
+    assert reads.count('compiled/shards-migrated') == 1
+    assert rocks_app.manifest_repository(S3Mock.instance.files['shards/baz'].decode('utf-8')) == \
+        {'baz': {'1.0-1': ['rockspec']}}
+
+
+def test_rebuild_manifest(app, monkeypatch):
+    import app as rocks_app
+    put("package = 'foo'\nversion = '1.0-1'\n", 'foo-1.0-1.rockspec')
+    put(b'zip', 'foo-1.0-1.all.rock', binary=True)
+    put("package = 'old'\nversion = 'scm-1'\n", 'old-scm-1.rockspec')
+
+    files = S3Mock.instance.files
+    del files['old-scm-1.rockspec']
+    files['bar-scm-1.rockspec'] = b"package = 'bar'\nversion = 'scm-2'\n"
+    files['baz-2.0-1.src.rock'] = b'zip'
+    files['manifest'] = b'repository = {'
+
+    # Small pages make the listing paginated, folders are not listed
+    for i in range(5):
+        files[f'audit/26-10/{i}.json'] = b'{}'
+    listed = []
+    list_objects_v2 = S3Mock.list_objects_v2
+
+    def small_list_objects_v2(self, **kwargs):
+        response = list_objects_v2(self, MaxKeys=2, **kwargs)
+        listed.extend(obj['Key'] for obj in response['Contents'])
+        return response
+
+    monkeypatch.setattr(S3Mock, 'list_objects_v2', small_list_objects_v2)
+
+    runner = rocks_app.app.test_cli_runner()
+    result = runner.invoke(rocks_app.rebuild_manifest, ['--workers', '4', '--dry-run'])
+    assert result.exit_code == 0, result.output
+    assert 'found 2 packages from 4 files' in result.output
+    assert not any(key.startswith(('audit/', 'manifests/', 'packages/')) for key in listed)
+    assert files['manifest'] == b'repository = {'
+
+    result = runner.invoke(rocks_app.rebuild_manifest, ['--workers', '4'])
+    assert result.exit_code == 0, result.output
+    assert 'skipped bar-scm-1.rockspec: rockspec name does not match package or version' \
+        in result.output
+    assert 'rebuilt 2 packages from 4 files' in result.output
+
+    expected = {'foo': {'1.0-1': ['all', 'rockspec']}, 'baz': {'2.0-1': ['src']}}
+    assert rocks_app.manifest_repository(files['manifest'].decode('utf-8')) == expected
+    assert sorted(key for key in files if key.startswith('shards/')) == ['shards/baz', 'shards/foo']
+    assert sorted(key for key in files if key.startswith('packages/')) == [
+        'packages/baz.html', 'packages/baz.json', 'packages/foo.html', 'packages/foo.json']
+    assert json.loads(files['packages/baz.json'])['versions'] == {'2.0-1': {'src': None}}
+    assert sorted(json.loads(files['packages/foo.json'])['versions']['1.0-1']) == ['all', 'rockspec']
+    assert sorted(json.loads(files['index.json'])['packages']) == ['baz', 'foo']
+    assert 'packages/old.html' not in files['index.html'].decode('utf-8')
+
+    # The next compilation keeps the rebuilt manifest
+    manifest = files['manifest']
+    rocks_app.S3View().compile_manifest()
+    assert files['manifest'] == manifest
+    assert get('manifest').headers['Location'] == \
+        f'/manifests/{rocks_app.snapshot_name(manifest)}'
+
+
+def test_incremental_compilation(app, monkeypatch):
+    import app as rocks_app
+    # Checksums of rocks uploaded before per-package checksums are kept
+    S3Mock().files['checksums.json'] = json.dumps({'old-1.0-1.all.rock': {'size': 1}}).encode()
+    put("package = 'foo'\nversion = 'scm-1'\n", 'foo-scm-1.rockspec')
+    put("package = 'bar'\nversion = 'scm-1'\n", 'bar-scm-1.rockspec')
+
+    checksums = json.loads(S3Mock.instance.files['checksums.json'])
+    assert sorted(checksums) == ['bar-scm-1.rockspec', 'foo-scm-1.rockspec', 'old-1.0-1.all.rock']
+    assert sorted(json.loads(S3Mock.instance.files['dependencies.json'])['forward']) == \
+        ['bar', 'foo']
+
+    fetches = []
+    get_object = S3Mock.get_object
+
+    def counting_get_object(self, Bucket, Key, **kwargs):
+        fetches.append(Key)
+        return get_object(self, Bucket, Key, **kwargs)
+
+    monkeypatch.setattr(S3Mock, 'get_object', counting_get_object)
+
+    # Only the parts changed since the last compilation are downloaded,
+    # whichever process compiled it
+    put("package = 'foo'\nversion = '1.0-1'\n", 'foo-1.0-1.rockspec')
+    compiled = [key for key in fetches if key.startswith(('checksums/', 'shards/', 'dependencies/'))]
+    assert 'shards/bar' not in compiled and 'checksums/bar.json' not in compiled
+    assert compiled.count('shards/foo') == 2  # the upload and the compilation
+
+    fetches.clear()
+    rocks_app.S3View().compile_indexes()
+    assert not [key for key in fetches if key.startswith('shards/')]
+
+    # Deleted shards remove their packages
+    del S3Mock.instance.files['shards/bar']
+    rocks_app.S3View().compile_indexes()
+    repository = rocks_app.manifest_repository(S3Mock.instance.files['manifest'].decode('utf-8'))
+    assert repository == {'foo': {'scm-1': ['rockspec'], '1.0-1': ['rockspec']}}
+    assert len([key for key in S3Mock.instance.files if key.startswith('compiled/manifest-')]) == 1
+
+    # Attempts lost to a concurrent write leave no compiled sources behind
+    put_object = S3Mock.put_object
+    raced = []
+
+    def racing_put_object(self, Bucket, Key, Body, **kwargs):
+        if Key == 'checksums.json' and not raced:
+            # Another process compiles the target in between
+            raced.append(Key)
+            sources = self.files.pop(rocks_app.compiled_sources_name(Key, self.files[Key]))
+            self.files[Key] = self.files[Key].replace(b'"size": 1', b'"size": 2')
+            self.files[rocks_app.compiled_sources_name(Key, self.files[Key])] = sources
+        return put_object(self, Bucket, Key, Body, **kwargs)
+
+    monkeypatch.setattr(S3Mock, 'put_object', racing_put_object)
+    put("package = 'foo'\nversion = '2.0-1'\n", 'foo-2.0-1.rockspec')
+    assert raced
+    compiled = [key for key in S3Mock.instance.files if key.startswith('compiled/checksums.json-')]
+    assert compiled == [rocks_app.compiled_sources_name('checksums.json',
+                                                        S3Mock.instance.files['checksums.json'])]
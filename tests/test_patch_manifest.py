@@ -331,3 +331,54 @@ def test_remove_last():
     msg, patched_manifest_2 = patch_manifest(patched_manifest_1, 'foo-bar-3.2-1.all.rock', action = 'remove')
     assert msg == "rock version was not found in manifest"
     assert patched_manifest_2 == None
+
+
+def test_shards():
+    from app import lua
+    manifest = dedent("""\
+        commands = {}
+        modules = {
+            cartridge = {
+                "cartridge/scm-1"
+            }
+        }
+        repository = {}
+    """)
+    _, manifest = patch_manifest(manifest, 'cartridge-2.0-1.all.rock')
+    _, manifest = patch_manifest(manifest, 'checks-3.1.0-1.all.rock')
+
+    msg, shard = patch_manifest(manifest, 'cartridge', action='shard')
+    assert msg == "shard was successfully extracted from manifest"
+    assert shard == dedent("""\
+        commands = {}
+        modules = {}
+        repository = {
+            cartridge = {
+                ["2.0-1"] = {
+                    {
+                        arch = "all"
+                    }
+                }
+            }
+        }
+    """)
+    _, empty_shard = patch_manifest(manifest, 'foo', action='shard')
+    assert empty_shard == "commands = {}\nmodules = {}\nrepository = {}\n"
+
+    msg, shards = patch_manifest(manifest, '', action='split')
+    assert msg == 'manifest was successfully split into shards'
+    assert dict(shards.items()) == {
+        'cartridge': shard,
+        'checks': patch_manifest(manifest, 'checks', action='shard')[1],
+    }
+
+    _, shard = patch_manifest(shard, 'cartridge-2.1-1.all.rock')
+    _, foo_shard = patch_manifest(empty_shard, 'foo-scm-1.all.rock')
+    msg, merged = patch_manifest(manifest, '', lua.table_from({'cartridge': shard, 'foo': foo_shard}),
+                                 action='merge')
+    assert msg == "shards were successfully merged into manifest"
+
+    _, expected = patch_manifest(manifest, 'cartridge-2.1-1.all.rock')
+    _, expected = patch_manifest(expected, 'foo-scm-1.all.rock')
+    assert merged == expected
+    assert '"cartridge/scm-1"' in merged